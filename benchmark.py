@@ -0,0 +1,242 @@
+"""离线基准测试：启动本地 OpenAI 兼容桩服务器，用可配置的延迟和预置响应测量 MDToJSONConverter 的吞吐量"""
+from md2json import MDToJSONConverter
+from metrics import Metrics
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import argparse
+import glob
+import itertools
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+
+
+def synthesize_response(system_prompt, chunk):
+    """根据 chunk 中的 #/## 标题和段落生成与真实模型输出结构一致的 JSON"""
+    chunk = chunk.split("【Raw OCR-scanned text】:", 1)[-1]
+    sections = []
+    references = []
+    current = None
+    for block in re.split(r"\n\s*\n", chunk):
+        block = block.strip()
+        match = re.match(r"^(#{1,2}) (.+)$", block.split("\n", 1)[0])
+        if match:
+            node = {"heading": match.group(2).strip(), "content": "", "subsections": []}
+            if len(match.group(1)) == 2 and sections:
+                sections[-1]["subsections"].append(node)
+            else:
+                sections.append(node)
+            current = node
+            block = block.split("\n", 1)[1].strip() if "\n" in block else ""
+        if not block:
+            continue
+        for line in block.split("\n"):
+            reference = re.match(r"^\s*(?:\[\d+\]|\d+\.)\s+(.+)$", line)
+            if reference and "references" in system_prompt:
+                references.append({"paper_name": reference.group(1)[:80], "content": reference.group(1)})
+        if current is not None:
+            current["content"] = (current["content"] + "\n\n" + block).strip()
+
+    result = {}
+    if "'authors'" in system_prompt:
+        result = {"title": sections[0]["heading"] if sections else "", "authors": [], "abstract": "", "keywords": []}
+    result["sections"] = sections
+    if "references" in system_prompt:
+        result["references"] = references
+    return "```json\n" + json.dumps(result, ensure_ascii=False, indent=2) + "\n```"
+
+
+class StubOpenAIServer:
+    """本地 OpenAI 兼容桩服务器，支持普通响应和 SSE 流式响应"""
+
+    def __init__(self, latency=0.5, token_latency=0.0, responses=None, host="127.0.0.1", port=0):
+        self.latency = latency
+        self.token_latency = token_latency
+        self.responses = itertools.cycle(responses) if responses else None
+        self.requests = 0
+        # 模拟服务商的前缀缓存：见过的系统提示词再次出现时计为缓存命中
+        self.seen_prefixes = set()
+        self._lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                server.handle(self, body)
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.base_url = f"http://{host}:{self.httpd.server_address[1]}/v1"
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def next_output(self, messages):
+        with self._lock:
+            self.requests += 1
+            if self.responses:
+                return next(self.responses)
+        return synthesize_response(messages[0]["content"], messages[1]["content"])
+
+    def handle(self, handler, body):
+        messages = body["messages"]
+        output = self.next_output(messages)
+        # 续写请求只返回尚未输出的部分
+        if len(messages) > 2 and messages[-2]["role"] == "assistant":
+            output = output[len(messages[-2]["content"]):]
+        prompt_tokens = sum(len(message["content"].split()) for message in messages)
+        completion_tokens = len(output.split())
+        with self._lock:
+            cached_tokens = len(messages[0]["content"].split()) if messages[0]["content"] in self.seen_prefixes else 0
+            self.seen_prefixes.add(messages[0]["content"])
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                 "total_tokens": prompt_tokens + completion_tokens,
+                 "prompt_tokens_details": {"cached_tokens": cached_tokens}}
+        time.sleep(self.latency)
+
+        if not body.get("stream"):
+            time.sleep(self.token_latency * completion_tokens)
+            payload = json.dumps({
+                "id": "stub", "object": "chat.completion", "created": int(time.time()), "model": body["model"],
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": output}}],
+                "usage": usage,
+            }).encode("utf-8")
+            handler.send_response(200)
+            handler.send_header("Content-Type", "application/json")
+            handler.send_header("Content-Length", str(len(payload)))
+            handler.end_headers()
+            handler.wfile.write(payload)
+            return
+
+        handler.send_response(200)
+        handler.send_header("Content-Type", "text/event-stream")
+        handler.end_headers()
+
+        def send(event):
+            handler.wfile.write(f"data: {json.dumps(event)}\n\n".encode("utf-8"))
+            handler.wfile.flush()
+
+        base = {"id": "stub", "object": "chat.completion.chunk", "created": int(time.time()), "model": body["model"]}
+        for piece in re.findall(r"\S+\s*|\s+", output):
+            time.sleep(self.token_latency)
+            send({**base, "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}]})
+        send({**base, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]})
+        send({**base, "choices": [], "usage": usage})
+        handler.wfile.write(b"data: [DONE]\n\n")
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def generate_paper(index, sections=12, paragraphs=4, references=30):
+    """生成结构规整的合成论文"""
+    words = "the model results method data analysis shows that performance under different conditions".split()
+    paragraph = lambda seed: " ".join(words[(seed + i) % len(words)] for i in range(120)) + "."
+    parts = [f"# Synthetic Paper {index}", "Alice Author, Bob Writer", "Abstract: " + paragraph(index),
+             "Keywords: model; data analysis; performance"]
+    for s in range(sections):
+        parts.append(f"# {s + 1} Section {s + 1}")
+        parts.extend(paragraph(s + p) for p in range(paragraphs // 2))
+        parts.append(f"## {s + 1}.1 Subsection {s + 1}.1")
+        parts.extend(paragraph(s + p + 1) for p in range(paragraphs - paragraphs // 2))
+    parts.append("# References")
+    parts.append("\n".join(f"{r + 1}. Author {r}. Title of referenced work {r}. Journal, 20{r % 25:02d}."
+                           for r in range(references)))
+    return "\n\n".join(parts)
+
+
+SCENARIOS = {
+    "sequential": {},
+    "concurrent": {"concurrent": True},
+    "stream": {"stream": True},
+    "local": {"local_parse": True},
+}
+
+
+def run_scenario(name, md_files, base_url, output_dir, max_token, max_workers):
+    """用一个场景的参数转换全部文件，返回吞吐量和指标汇总"""
+    options = SCENARIOS[name]
+    metrics = Metrics()
+    prompt_tokens = completion_tokens = cached_prompt_tokens = 0
+    local_chunks = llm_chunks = 0
+    start_time = time.perf_counter()
+    for md_file in md_files:
+        converter = MDToJSONConverter("stub-key", base_url, "stub-model", metrics=metrics,
+                                      stream=options.get("stream", False), local_parse=options.get("local_parse", False))
+        output_file = os.path.join(output_dir, f"{name}-{os.path.basename(md_file)}.json")
+        converter.convert(md_file, output_file, concurrent=options.get("concurrent", False),
+                          max_workers=max_workers, max_token=max_token, resume=False)
+        prompt_tokens += converter.prompt_tokens
+        completion_tokens += converter.completion_tokens
+        cached_prompt_tokens += converter.cached_prompt_tokens
+        local_chunks += converter.local_chunks
+        llm_chunks += converter.llm_chunks
+    elapsed = time.perf_counter() - start_time
+    return {
+        "scenario": name,
+        "files": len(md_files),
+        "seconds": elapsed,
+        "files_per_minute": len(md_files) / elapsed * 60 if elapsed else 0,
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "cached_prompt_tokens": cached_prompt_tokens,
+        "llm_calls_avoided": local_chunks / (local_chunks + llm_chunks) if local_chunks + llm_chunks else 0,
+        "metrics": metrics.summary(),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="使用本地桩服务器对 Markdown 转 JSON 做离线基准测试")
+    parser.add_argument("--input-dir", help="Markdown 文件目录；不指定时使用合成论文")
+    parser.add_argument("--synthetic", type=int, default=3, help="合成论文数量")
+    parser.add_argument("--latency", type=float, default=0.5, help="每次请求的固定延迟（秒）")
+    parser.add_argument("--token-latency", type=float, default=0.0, help="每个输出 token 的延迟（秒）")
+    parser.add_argument("--responses", help="预置响应 JSON 文件（字符串列表，按顺序循环返回）")
+    parser.add_argument("--scenarios", default="sequential,concurrent,stream,local", help="逗号分隔的场景列表")
+    parser.add_argument("--max-token", type=int, default=3000, help="每个 chunk 的 token 上限")
+    parser.add_argument("--max-workers", type=int, default=4, help="并发场景下单个文件的并发 chunk 数")
+    parser.add_argument("--output", help="保存基准结果的 JSON 文件")
+    args = parser.parse_args()
+
+    responses = None
+    if args.responses:
+        with open(args.responses, "r", encoding="utf-8") as file:
+            responses = json.load(file)
+
+    server = StubOpenAIServer(latency=args.latency, token_latency=args.token_latency, responses=responses).start()
+    with tempfile.TemporaryDirectory() as work_dir:
+        if args.input_dir:
+            md_files = sorted(glob.glob(os.path.join(args.input_dir, "**", "*.md"), recursive=True))
+        else:
+            md_files = []
+            for i in range(args.synthetic):
+                md_file = os.path.join(work_dir, f"synthetic-{i}.md")
+                with open(md_file, "w", encoding="utf-8") as file:
+                    file.write(generate_paper(i))
+                md_files.append(md_file)
+
+        results = []
+        for name in args.scenarios.split(","):
+            results.append(run_scenario(name.strip(), md_files, server.base_url, work_dir,
+                                        args.max_token, args.max_workers))
+    server.stop()
+
+    print("\n基准结果:")
+    for result in results:
+        print(f"  {result['scenario']:<12} 文件数: {result['files']}, 耗时: {result['seconds']:.2f} 秒, "
+              f"吞吐量: {result['files_per_minute']:.1f} 文件/分钟, "
+              f"输入tokens: {result['prompt_tokens']} (缓存命中 {result['cached_prompt_tokens']}), 输出tokens: {result['completion_tokens']}, "
+              f"避免的 LLM 调用: {result['llm_calls_avoided']:.0%}")
+    print(f"  桩服务器请求数: {server.requests}")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(results, file, ensure_ascii=False, indent=4)
+        print(f"基准结果已保存至 {args.output}")
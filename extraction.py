@@ -1,60 +1,202 @@
 from md2json import MDToJSONConverter
+from llm_cache import LLMResponseCache
+from manifest import hash_text, load_manifest, manifest_path
+from metrics import Metrics
+from rate_limiter import RateLimiter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from openai import DEFAULT_CONNECTION_LIMITS, DefaultHttpxClient, OpenAI
 import argparse
 import glob
 import os
+import shutil
+import threading
 import time
 
+
+def convert_file(file_dir, args, client, request_semaphore, cache, metrics, rate_limiter):
+    """转换单个文件，返回完成转换的 converter 和转换耗时"""
+    converter = MDToJSONConverter(llm_dict[args.model]["key"], llm_dict[args.model]["base_url"], args.model,
+                                  client=client, request_semaphore=request_semaphore, cache=cache,
+                                  tokenizer=args.tokenizer, stream=args.stream, metrics=metrics,
+                                  rate_limiter=rate_limiter, preclean=args.preclean, local_parse=args.local_parse,
+                                  local_confidence=args.local_confidence)
+    file_name = os.path.basename(file_dir)
+    output_file = file_dir.replace(".md", ".json")
+
+    start_time = time.time()
+    converter.convert(file_dir, output_file, concurrent=args.concurrent, max_workers=args.chunk_workers,
+                      max_token=args.max_token, resume=not args.no_resume, incremental=not args.full)
+    conversion_time = time.time() - start_time
+
+    print(f"[{file_name}] 转换耗时: {conversion_time:.2f} 秒")
+    print(f"[{file_name}] 输入tokens: {converter.prompt_tokens} (缓存命中 {converter.cached_prompt_tokens}), 输出tokens: {converter.completion_tokens}")
+    print(f"[{file_name}] 文件成本: ${converter.calculate_token_price(llm_dict[args.model]['input_price'], llm_dict[args.model]['output_price'], llm_dict[args.model]['cached_input_price']):.4f}")
+    return converter, conversion_time
+
+
+def copy_output(source_output, output_file):
+    """内容相同的文件直接复制已有的输出和 manifest"""
+    shutil.copyfile(source_output, output_file)
+    shutil.copyfile(manifest_path(source_output), manifest_path(output_file))
+
+
+llm_dict = {
+    "qwen2.5-72b-instruct": {
+        "key": "sk-a1ec916362f94e9daf9a0147ad376f54",
+        "base_url": "https://dashscope.aliyuncs.com/compatible-mode/v1",
+        "input_price": 0.004,
+        "output_price": 0.012,
+        "cached_input_price": 0.0016,
+        "requests_per_minute": 600,
+        "tokens_per_minute": 1000000
+    },
+    "gpt-4o": {
+        "key": "fk216003-Hrxi38NKWLTTErTeh75OJiLIj95rmg69",
+        "base_url": "https://openai.api2d.net",
+        "input_price": 0.00875,
+        "output_price": 0.035,
+        "cached_input_price": 0.004375,
+        "requests_per_minute": 500,
+        "tokens_per_minute": 300000
+    }
+}
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="将Markdown文件转换为JSON格式")
     parser.add_argument("input_dir", help="输入Markdown文件所在的目录")
     parser.add_argument("--model", default="qwen2.5-72b-instruct", choices=["qwen2.5-72b-instruct", "gpt-4o"], help="选择使用的模型")
+    parser.add_argument("--workers", type=int, default=4, help="同时处理的文件数")
+    parser.add_argument("--max-requests", type=int, default=8, help="全局同时进行的 API 请求上限")
+    parser.add_argument("--concurrent", action="store_true", help="单个文件内部的 chunk 也并发处理")
+    parser.add_argument("--chunk-workers", type=int, default=4, help="单个文件内部并发处理的 chunk 数")
+    parser.add_argument("--full", action="store_true", help="源文件变化时整篇重新转换，而不是只处理变化的章节")
+    parser.add_argument("--no-resume", action="store_true", help="不使用 chunk 日志续跑，每个文件从头转换")
+    parser.add_argument("--preclean", choices=["conservative", "strict"], help="发送给 LLM 之前在本地清理图片、公式、表格等内容")
+    parser.add_argument("--local-parse", action="store_true", help="格式规整的 chunk 直接在本地解析 Markdown 结构，不调用 LLM")
+    parser.add_argument("--local-confidence", type=float, default=0.8, help="本地解析结果被采用的最低置信度")
+    parser.add_argument("--stream", action="store_true", help="使用流式输出并增量解析")
+    parser.add_argument("--max-token", type=int, default=3000, help="每个 chunk 的 token 上限")
+    parser.add_argument("--tokenizer", default="heuristic", choices=["heuristic", "tiktoken"], help="计算 token 数使用的分词器")
+    parser.add_argument("--metrics-jsonl", help="逐次记录指标事件的 JSON lines 文件")
+    parser.add_argument("--metrics-prom", help="运行结束后写出 Prometheus 文本格式指标的文件")
+    parser.add_argument("--cache", default=".llm_cache.sqlite", help="LLM 响应缓存文件路径，设为空字符串则不使用缓存")
+    parser.add_argument("--cache-max-mb", type=int, default=1024, help="缓存大小上限（MB）")
+    parser.add_argument("--cache-max-days", type=int, default=30, help="缓存条目最长保留天数")
     args = parser.parse_args()
 
-    llm_dict = {
-        "qwen2.5-72b-instruct": {
-            "key": "sk-a1ec916362f94e9daf9a0147ad376f54",
-            "base_url": "https://dashscope.aliyuncs.com/compatible-mode/v1",
-            "input_price": 0.004,
-            "output_price": 0.012
-        },
-        "gpt-4o": {
-            "key": "fk216003-Hrxi38NKWLTTErTeh75OJiLIj95rmg69",
-            "base_url": "https://openai.api2d.net",
-            "input_price": 0.00875,
-            "output_price": 0.035
-        }
-    }
-    
     md_files = glob.glob(os.path.join(args.input_dir, '**', '*.md'), recursive=True)
     total_files = len(md_files)
     total_time = 0
     total_prompt_tokens = 0
     total_completion_tokens = 0
+    total_cached_prompt_tokens = 0
+    total_cache_hits = 0
+    total_cache_misses = 0
+    total_hierarchy_tokens_saved = 0
+    total_preclean_bytes = 0
+    total_preclean_tokens = 0
+    total_parse_stats = {}
+    total_local_chunks = 0
+    total_llm_chunks = 0
+
+    # 所有文件共用一个 client 和连接池，空闲的 worker 从共享队列中领取下一个文件
+    client = OpenAI(
+        api_key=llm_dict[args.model]["key"],
+        base_url=llm_dict[args.model]["base_url"],
+        timeout=300,
+        max_retries=0,  # 重试统一由 MDToJSONConverter.call_openai_api 处理
+        # 使用 SDK 自带的 http client 和 Limits 类型，不依赖具体的 httpx 实现
+        http_client=DefaultHttpxClient(limits=type(DEFAULT_CONNECTION_LIMITS)(
+            max_connections=args.max_requests, max_keepalive_connections=args.max_requests))
+    )
+    request_semaphore = threading.BoundedSemaphore(args.max_requests)
+    metrics = Metrics(jsonl_path=args.metrics_jsonl)
+    # 同一服务商的所有在途请求共享限流额度，每分钟请求数和 token 数上限请按账号的实际配额调整
+    rate_limiter = RateLimiter(llm_dict[args.model]["requests_per_minute"], llm_dict[args.model]["tokens_per_minute"])
+    cache = None
+    if args.cache:
+        cache = LLMResponseCache(args.cache, max_bytes=args.cache_max_mb * 1024 * 1024,
+                                 max_age=args.cache_max_days * 24 * 3600)
+
+    # 已有输出按源文件内容哈希建立索引，重命名或重复的文件直接复用
+    converted_outputs = {}
+    for manifest_file in glob.glob(os.path.join(args.input_dir, '**', '*.manifest.json'), recursive=True):
+        manifest = load_manifest(manifest_file)
+        output_file = manifest_file[:-len(".manifest.json")] + ".json"
+        if manifest and os.path.exists(output_file):
+            converted_outputs[manifest["source_hash"]] = output_file
 
-    for i, file_dir in enumerate(md_files, 1):
-        converter = MDToJSONConverter(llm_dict[args.model]["key"], llm_dict[args.model]["base_url"], args.model)
+    # 同一内容只转换一次，其余重复文件在转换完成后复制结果
+    pending_files = {}
+    for file_dir in md_files:
         file_name = os.path.basename(file_dir)
-        # 如果已经存在.json文件，则跳过
-        if os.path.exists(file_dir.replace(".md", ".json")):
-            print(f"文件 {file_name} 已处理过，跳过")
-            continue
         output_file = file_dir.replace(".md", ".json")
-        
-        print(f"处理文件 {i}/{total_files}: {file_name}")
-        start_time = time.time()
-        converter.convert(file_dir, output_file)
-        end_time = time.time()
-        conversion_time = end_time - start_time
-        total_time += conversion_time
-
-        print(f"  转换耗时: {conversion_time:.2f} 秒")
-        print(f"  输入tokens: {converter.prompt_tokens}, 输出tokens: {converter.completion_tokens}")
-        print(f"  文件成本: ${converter.calculate_token_price(llm_dict[args.model]['input_price'], llm_dict[args.model]['output_price']):.4f}")
-        
-        total_prompt_tokens += converter.prompt_tokens
-        total_completion_tokens += converter.completion_tokens
-        
+        with open(file_dir, "r", encoding="utf-8") as file:
+            source_hash = hash_text(file.read())
+        if os.path.exists(output_file):
+            manifest = load_manifest(manifest_path(output_file))
+            if manifest is None:
+                print(f"文件 {file_name} 已处理过（没有 manifest），跳过")
+                continue
+            if manifest["source_hash"] == source_hash:
+                print(f"文件 {file_name} 内容未变化，跳过")
+                continue
+        elif source_hash in converted_outputs:
+            copy_output(converted_outputs[source_hash], output_file)
+            print(f"文件 {file_name} 与 {converted_outputs[source_hash]} 内容相同，直接复制结果")
+            continue
+        pending_files.setdefault(source_hash, []).append(file_dir)
+
+    batch_start_time = time.time()
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        futures = {executor.submit(convert_file, file_dirs[0], args, client, request_semaphore, cache, metrics,
+                                   rate_limiter): file_dirs
+                   for file_dirs in pending_files.values()}
+        for i, future in enumerate(as_completed(futures), 1):
+            file_dirs = futures[future]
+            file_name = os.path.basename(file_dirs[0])
+            try:
+                converter, conversion_time = future.result()
+            except Exception as e:
+                print(f"处理文件 {file_name} 失败: {e}")
+                continue
+            print(f"已完成 {i}/{len(pending_files)}: {file_name}")
+            for duplicate in file_dirs[1:]:
+                copy_output(file_dirs[0].replace(".md", ".json"), duplicate.replace(".md", ".json"))
+                print(f"文件 {os.path.basename(duplicate)} 与 {file_name} 内容相同，直接复制结果")
+            total_time += conversion_time
+            total_prompt_tokens += converter.prompt_tokens
+            total_completion_tokens += converter.completion_tokens
+            total_cached_prompt_tokens += converter.cached_prompt_tokens
+            total_cache_hits += converter.cache_hits
+            total_cache_misses += converter.cache_misses
+            total_hierarchy_tokens_saved += converter.hierarchy_tokens_saved
+            total_preclean_bytes += sum(stats["bytes"] for stats in converter.preclean_stats.values())
+            total_preclean_tokens += sum(stats["tokens"] for stats in converter.preclean_stats.values())
+            total_local_chunks += converter.local_chunks
+            total_llm_chunks += converter.llm_chunks
+            for name, count in converter.parse_stats.items():
+                total_parse_stats[name] = total_parse_stats.get(name, 0) + count
+
     print("\n总结:")
-    print(f"总转换时间: {total_time:.2f} 秒")
-    print(f"总输入tokens: {total_prompt_tokens}, 总输出tokens: {total_completion_tokens}")
-    print(f"总成本: ${(total_prompt_tokens / 1000 * llm_dict[args.model]['input_price'] + total_completion_tokens / 1000 * llm_dict[args.model]['output_price']):.4f}")
\ No newline at end of file
+    print(f"文件总数: {total_files}, 本次转换: {len(pending_files)}")
+    print(f"总转换时间: {total_time:.2f} 秒, 实际耗时: {time.time() - batch_start_time:.2f} 秒")
+    print(f"总输入tokens: {total_prompt_tokens} (缓存命中 {total_cached_prompt_tokens}), 总输出tokens: {total_completion_tokens}")
+    print(f"总成本: ${((total_prompt_tokens - total_cached_prompt_tokens) / 1000 * llm_dict[args.model]['input_price'] + total_cached_prompt_tokens / 1000 * llm_dict[args.model]['cached_input_price'] + total_completion_tokens / 1000 * llm_dict[args.model]['output_price']):.4f}")
+    print(f"层级上下文节省 tokens: {total_hierarchy_tokens_saved}")
+    if args.preclean:
+        print(f"预清理移除: {total_preclean_bytes} 字节, {total_preclean_tokens} tokens")
+    if args.local_parse and total_local_chunks + total_llm_chunks:
+        print(f"本地解析 chunk: {total_local_chunks}/{total_local_chunks + total_llm_chunks}，"
+              f"避免了 {total_local_chunks / (total_local_chunks + total_llm_chunks):.0%} 的 LLM 调用")
+    if total_parse_stats:
+        parsed = sum(count for name, count in total_parse_stats.items() if name in ("orjson", "json", "json5", "salvage"))
+        print(f"JSON 解析 ({args.model}): " + ", ".join(f"{name} {count}" for name, count in sorted(total_parse_stats.items())))
+        print(f"修复率: {total_parse_stats.get('repair_requests', 0) / max(parsed, 1):.2%} (每个 chunk 的修复请求数)")
+    if cache:
+        print(f"缓存命中: {total_cache_hits}, 未命中: {total_cache_misses}")
+        cache.close()
+    if args.metrics_prom:
+        metrics.save_prometheus(args.metrics_prom)
+        print(f"指标已保存至 {args.metrics_prom}")
+    metrics.close()
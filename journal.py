@@ -0,0 +1,79 @@
+import hashlib
+import json
+import os
+import threading
+
+try:
+    import fcntl
+except ImportError:  # Windows 下没有 fcntl，只用进程内的锁
+    fcntl = None
+
+
+def hash_chunk(chunk):
+    """计算 chunk 文本的哈希，用于判断日志记录是否仍然有效"""
+    return hashlib.sha256(chunk.encode("utf-8")).hexdigest()
+
+
+def hash_settings(settings):
+    """计算转换设置的哈希；模型、预清理模式等设置不同时，已完成的 chunk 不能复用"""
+    return hashlib.sha256(json.dumps(settings, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class ChunkJournal:
+    """单篇论文的只追加 chunk 日志，每行一条 JSON 记录，支持中断后续跑"""
+
+    def __init__(self, path, settings=None):
+        self.path = path
+        self.settings_hash = hash_settings(settings)
+        self._lock = threading.Lock()
+
+    def load(self):
+        """读取已完成的记录，返回 {chunk 序号: 记录}；崩溃时写了一半的行会被忽略"""
+        records = {}
+        if not os.path.exists(self.path):
+            return records
+        with open(self.path, "r", encoding="utf-8") as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                records[record["index"]] = record
+        return records
+
+    def append(self, index, kind, chunk, result):
+        """追加一条记录：整行一次写入并 fsync，多进程写入时用文件锁串行化"""
+        record = {
+            "index": index,
+            "kind": kind,
+            "chunk_hash": hash_chunk(chunk),
+            "settings_hash": self.settings_hash,
+            "result": result,
+        }
+        data = (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+        with self._lock:
+            fd = os.open(self.path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                if fcntl:
+                    fcntl.flock(fd, fcntl.LOCK_EX)
+                # 上一次崩溃可能留下没有换行符的半行，先补一个换行避免与新记录粘连
+                if os.fstat(fd).st_size:
+                    os.lseek(fd, -1, os.SEEK_END)
+                    if os.read(fd, 1) != b"\n":
+                        data = b"\n" + data
+                os.write(fd, data)
+                os.fsync(fd)
+            finally:
+                if fcntl:
+                    fcntl.flock(fd, fcntl.LOCK_UN)
+                os.close(fd)
+
+    def matches(self, record, kind, chunk):
+        """判断日志记录是否对应同一类型、同一内容、同一转换设置下的 chunk"""
+        return (record is not None and record["kind"] == kind and record["chunk_hash"] == hash_chunk(chunk)
+                and record.get("settings_hash") == self.settings_hash)
+
+    def remove(self):
+        """转换完成后删除日志"""
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -0,0 +1,91 @@
+import hashlib
+import sqlite3
+import threading
+import time
+
+
+class LLMResponseCache:
+    """基于 SQLite 的 LLM 响应缓存，键为 模型 + 系统提示词 + chunk 文本 的哈希"""
+
+    def __init__(self, db_path, max_bytes=1024 * 1024 * 1024, max_age=30 * 24 * 3600):
+        self.db_path = db_path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                output TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )"""
+        )
+        self._conn.commit()
+        self.evict()
+
+    def make_key(self, model, system_prompt, chunk):
+        """计算缓存键"""
+        digest = hashlib.sha256()
+        for part in (model, system_prompt, chunk):
+            digest.update(part.encode("utf-8"))
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def get(self, key):
+        """读取缓存，未命中或已过期时返回 None；过期的条目直接删除"""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT output, created_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if self.max_age and now - row[1] > self.max_age:
+                self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._conn.commit()
+                return None
+            self._conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            return row[0]
+
+    def put(self, key, output):
+        """写入缓存，并在超出容量时淘汰"""
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, output, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                (key, output, len(output.encode("utf-8")), now, now),
+            )
+            self._conn.commit()
+        self.evict()
+
+    def delete(self, key):
+        """删除一条缓存，用于模型返回了无法使用的输出时避免下次命中"""
+        with self._lock:
+            self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self._conn.commit()
+
+    def evict(self):
+        """删除过期条目；总大小超过 max_bytes 时按最近访问时间淘汰最旧的条目"""
+        with self._lock:
+            if self.max_age:
+                self._conn.execute("DELETE FROM responses WHERE created_at < ?", (time.time() - self.max_age,))
+            if self.max_bytes:
+                total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+                if total > self.max_bytes:
+                    rows = self._conn.execute("SELECT key, size FROM responses ORDER BY accessed_at").fetchall()
+                    stale = []
+                    for key, size in rows:
+                        if total <= self.max_bytes:
+                            break
+                        stale.append((key,))
+                        total -= size
+                    self._conn.executemany("DELETE FROM responses WHERE key = ?", stale)
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
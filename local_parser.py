@@ -0,0 +1,303 @@
+import re
+from preclean import MarkdownPreCleaner
+
+HEADING_PATTERN = re.compile(r"^(#{1,6})\s+(.+?)\s*#*\s*$")
+# 章节编号：2 / 2.1 / 2.1.3，罗马数字 II，字母 A（IEEE 风格的二级标题）
+NUMBERING_PATTERN = re.compile(r"^((?:\d{1,2}\.)*\d{1,2})\.?\s+\S")
+ROMAN_PATTERN = re.compile(r"^(?=[IVX])M{0,3}(?:C[MD]|D?C{0,3})(?:X[CL]|L?X{0,3})(?:I[XV]|V?I{0,3})\.\s+\S")
+LETTER_PATTERN = re.compile(r"^[A-H]\.\s+\S")
+
+ABSTRACT_PATTERN = re.compile(r"^\s*(?:abstract|summary|摘要)\b\s*[:.—–-]?\s*", re.IGNORECASE)
+KEYWORDS_PATTERN = re.compile(r"^\s*(?:key\s*words?|index terms|关键词)\b\s*[:.—–-]?\s*", re.IGNORECASE)
+REFERENCES_HEADING_PATTERN = re.compile(
+    r"^(?:[\dIVX]+\.?\s*)?(?:references?|bibliography|literature cited|works cited|参考文献)\s*$", re.IGNORECASE)
+# OCR 输出中参考文献标题常常不是 # 标题，而是单独一行的 **References** / REFERENCES / References:
+REFERENCES_LABEL_PATTERN = re.compile(
+    r"^(?:\*\*|__)?\s*(?:[\dIVX]+\.?\s*)?(?:references?|bibliography|literature cited|works cited|参考文献)"
+    r"\s*[:：]?\s*(?:\*\*|__)?$", re.IGNORECASE)
+FRONT_MATTER_PATTERN = re.compile(
+    r"universit|institut|department|school of|college|laborator|academy|@|correspond|received|accepted|"
+    r"available online|doi|©|copyright|journal|elsevier|springer|wiley|licen[cs]e|e-mail", re.IGNORECASE)
+AUTHOR_MARKER_PATTERN = re.compile(r"[\d*†‡§¶]+|\s+[a-z](?:,[a-z])*$")
+KEYWORD_SEPARATOR_PATTERN = re.compile(r"[,;·•]|\s{2,}")
+
+REFERENCE_MARKER_PATTERN = re.compile(r"^\s*(?:\[(\d+)\]|(\d+)[.)])\s+")
+AUTHOR_YEAR_START_PATTERN = re.compile(r"^[A-Z][A-Za-z'’\-]+,\s+(?:[A-Z]\.|[A-Z][a-z]+)")
+YEAR_PATTERN = re.compile(r"\b(?:19|20)\d{2}[a-z]?\b")
+TITLE_AFTER_YEAR_PATTERN = re.compile(r"\(?\b(?:19|20)\d{2}[a-z]?\)?[.,:]\s+(.+?[.?!])(?=\s|$)")
+QUOTED_TITLE_PATTERN = re.compile(r"[\"“](.+?)[,.]?[\"”]")
+
+# 正文中常见的标点之外的字符比例过高说明 OCR 质量差，交给 LLM 清理
+ALLOWED_SYMBOLS = set(".,;:!?()[]{}'\"‘’“”-–—/%&+=<>*#_~@$§°·•…")
+NOISE_TOLERANCE = 0.02
+# 清理掉的内容超过这个比例时降低置信度；被当作乱码删除的内容更可能是误删的正文，容忍度更低
+REMOVED_TOLERANCE = 0.05
+GARBAGE_TOLERANCE = 0.01
+
+
+class LocalStructureParser:
+    """不调用 LLM，直接根据 Markdown 的 #/## 标题、段落和编号参考文献生成与模型输出相同结构的 chunk 结果，
+    并给出 0~1 的置信度；置信度低的 chunk 仍应交给 LLM 处理
+
+    preclean 为转换器使用的预清理模式；未开启预清理时按 conservative 模式去掉图片、公式和表格，与 LLM 的处理一致
+    """
+
+    def __init__(self, preclean=None):
+        self.preclean = preclean or "conservative"
+
+    def parse(self, kind, chunk):
+        """返回 (结果, 置信度, 扣分原因列表)"""
+        cleaner = MarkdownPreCleaner(self.preclean)
+        text = cleaner.clean(chunk)
+        blocks = self.split_blocks(text)
+        confidence = 1.0
+        reasons = []
+
+        def penalize(factor, reason):
+            nonlocal confidence
+            confidence *= factor
+            reasons.append(reason)
+
+        # 清理删掉的内容越多，本地结果丢失正文的风险越大
+        chunk_bytes = max(len(chunk.encode("utf-8")), 1)
+        removed = cleaner.total_removed()[0] / chunk_bytes
+        if removed > REMOVED_TOLERANCE:
+            penalize(max(0.0, 1 - (removed - REMOVED_TOLERANCE) * 4), f"清理删除了 {removed:.1%} 的内容")
+        garbage = cleaner.stats.get("garbage", {}).get("bytes", 0) / chunk_bytes
+        if garbage > GARBAGE_TOLERANCE:
+            penalize(max(0.0, 1 - (garbage - GARBAGE_TOLERANCE) * 20), f"{garbage:.1%} 的内容被当作乱码删除")
+
+        result = {}
+        if kind == "first":
+            metadata, blocks = self.extract_front_matter(blocks, penalize)
+            result.update(metadata)
+        elif blocks and blocks[0][1] is None:
+            penalize(0.0, "chunk 以正文开头，属于上一个章节的后续部分")
+
+        references = []
+        reference_text = self.extract_references(blocks)
+        if reference_text is not None and kind != "final":
+            penalize(0.0, "参考文献不在 final chunk 中")
+        elif reference_text is not None:
+            references, reference_confidence = self.parse_references(reference_text)
+            if reference_confidence < 1.0:
+                penalize(reference_confidence, f"参考文献题名识别置信度 {reference_confidence:.2f}")
+        elif kind == "final":
+            # 参考文献可能以无法识别的形式混在正文里，本地结果会把它们当作正文，交给 LLM 处理
+            penalize(0.0, "final chunk 中没有找到参考文献")
+
+        for _, heading, _ in blocks:
+            if heading is not None and len(heading.split()) > 25:
+                penalize(0.5, f"标题过长，可能是误识别的正文: {heading[:40]}")
+        noise = self.noise_ratio(text)
+        if noise > NOISE_TOLERANCE:
+            penalize(max(0.0, 1 - (noise - NOISE_TOLERANCE) * 10), f"非常规字符比例 {noise:.1%}")
+
+        result["sections"] = self.nest_sections(blocks)
+        if kind == "final":
+            result["references"] = references
+        return result, confidence, reasons
+
+    def split_blocks(self, text):
+        """按 #/## 标题拆分为 [层级, 标题, 段落列表]；第一个标题之前的正文层级和标题为 None，更深的标题视为正文"""
+        blocks = [[None, None, []]]
+        paragraph = []
+
+        def flush():
+            if paragraph:
+                blocks[-1][2].append("\n".join(paragraph))
+                paragraph.clear()
+
+        for line in text.split("\n"):
+            match = HEADING_PATTERN.match(line)
+            if match and len(match.group(1)) <= 2:
+                flush()
+                blocks.append([len(match.group(1)), match.group(2).strip(), []])
+            elif not line.strip():
+                flush()
+            else:
+                # 行内公式、图片被移除后留下的连续空格合并为一个
+                paragraph.append(re.sub(r"[ \t]{2,}", " ", match.group(2) if match else line).strip())
+        flush()
+        if not blocks[0][2]:
+            blocks.pop(0)
+        return blocks
+
+    def extract_references(self, blocks):
+        """找到参考文献部分并从标题块中移除，返回其文本；没有时返回 None。
+        先找 #/## 参考文献标题，再找正文中单独一行的 References 标签，标签之后到下一个标题之前的内容都是参考文献"""
+        for index, (_, heading, paragraphs) in enumerate(blocks):
+            if heading is not None and REFERENCES_HEADING_PATTERN.match(heading):
+                del blocks[index]
+                return "\n".join(paragraphs)
+        for _, _, paragraphs in blocks:
+            for paragraph_index, paragraph in enumerate(paragraphs):
+                lines = paragraph.split("\n")
+                for line_index, line in enumerate(lines):
+                    if not REFERENCES_LABEL_PATTERN.match(line.strip()):
+                        continue
+                    reference_text = "\n".join(lines[line_index + 1:] + paragraphs[paragraph_index + 1:])
+                    del paragraphs[paragraph_index:]
+                    if line_index:
+                        paragraphs.append("\n".join(lines[:line_index]))
+                    return reference_text
+        return None
+
+    def heading_depth(self, level, heading):
+        """根据章节编号推断层级，没有编号时使用 Markdown 标题层级"""
+        match = NUMBERING_PATTERN.match(heading)
+        if match:
+            return match.group(1).count(".") + 1
+        if ROMAN_PATTERN.match(heading):
+            return 1
+        if LETTER_PATTERN.match(heading):
+            return 2
+        return level
+
+    def nest_sections(self, blocks):
+        """按层级把标题块组织为 sections/subsections；找不到上级的标题放在顶层"""
+        sections = []
+        stack = []
+        for level, heading, paragraphs in blocks:
+            node = {"heading": heading, "content": "\n\n".join(paragraphs), "subsections": []}
+            depth = self.heading_depth(level, heading) if heading is not None else 1
+            while stack and stack[-1][0] >= depth:
+                stack.pop()
+            (stack[-1][1]["subsections"] if stack else sections).append(node)
+            stack.append((depth, node))
+        return sections
+
+    def extract_front_matter(self, blocks, penalize):
+        """从第一个 chunk 中识别 title/authors/abstract/keywords，返回 (元数据, 剩余的标题块)"""
+        metadata = {"title": "", "authors": [], "abstract": "", "keywords": []}
+        title_index = next((i for i, block in enumerate(blocks) if block[1] is not None), None)
+        if title_index is None:
+            penalize(0.0, "没有找到标题")
+            return metadata, blocks
+        metadata["title"] = blocks[title_index][1]
+        front_paragraphs = [p for block in blocks[:title_index] for p in block[2]] + blocks[title_index][2]
+        rest = blocks[title_index + 1:]
+
+        # 标题之后紧跟的 Abstract / Keywords 标题块也属于元数据
+        while rest and (ABSTRACT_PATTERN.fullmatch(rest[0][1]) or KEYWORDS_PATTERN.match(rest[0][1])):
+            level, heading, paragraphs = rest.pop(0)
+            if ABSTRACT_PATTERN.fullmatch(heading):
+                metadata["abstract"] = "\n\n".join(paragraphs)
+            else:
+                front_paragraphs.append(heading + " " + " ".join(paragraphs))
+
+        unlabeled = []
+        for paragraph in front_paragraphs:
+            if KEYWORDS_PATTERN.match(paragraph):
+                keywords = KEYWORDS_PATTERN.sub("", paragraph, count=1)
+                metadata["keywords"] = [k.strip(" .") for k in KEYWORD_SEPARATOR_PATTERN.split(keywords) if k.strip(" .")]
+            elif ABSTRACT_PATTERN.match(paragraph):
+                metadata["abstract"] = ABSTRACT_PATTERN.sub("", paragraph, count=1)
+            elif FRONT_MATTER_PATTERN.search(paragraph):
+                continue
+            elif not metadata["authors"] and not metadata["abstract"] and self.looks_like_authors(paragraph):
+                metadata["authors"] = self.split_authors(paragraph)
+            else:
+                unlabeled.append(paragraph)
+
+        if not metadata["abstract"] and unlabeled and len(unlabeled[0].split()) >= 40:
+            metadata["abstract"] = unlabeled.pop(0)
+            penalize(0.85, "摘要没有标注，按位置推断")
+        if unlabeled:
+            penalize(0.7 ** len(unlabeled), f"{len(unlabeled)} 段无法归类的前置内容")
+        if not metadata["abstract"]:
+            penalize(0.6, "没有找到摘要")
+        if not metadata["authors"]:
+            penalize(0.8, "没有找到作者")
+        return metadata, rest
+
+    def looks_like_authors(self, paragraph):
+        """较短、不以句号结尾、大部分单词首字母大写的段落视为作者列表"""
+        words = paragraph.split()
+        if not words or len(words) > 40 or paragraph.rstrip().endswith("."):
+            return False
+        capitalized = sum(1 for word in words if word[0].isupper() or not word[0].isalpha())
+        return capitalized / len(words) >= 0.6
+
+    def split_authors(self, paragraph):
+        names = re.split(r",|;|\band\b|&|\n", paragraph)
+        names = [AUTHOR_MARKER_PATTERN.sub("", name).strip(" .") for name in names]
+        return [name for name in names if len(name) > 1]
+
+    def split_reference_entries(self, text):
+        """按编号（[1] / 1. / 1)）或“姓, 名首字母”开头拆分参考文献条目，续行合并到上一条；
+        返回 (条目列表, 编号是否连续)"""
+        lines = [line.strip() for line in text.split("\n") if line.strip()]
+        numbered = bool(lines) and REFERENCE_MARKER_PATTERN.match(lines[0]) is not None
+        entries = []
+        numbers = []
+        for line in lines:
+            marker = REFERENCE_MARKER_PATTERN.match(line)
+            if numbered:
+                starts_entry = marker is not None
+            else:
+                starts_entry = (not entries or (AUTHOR_YEAR_START_PATTERN.match(line) is not None
+                                                and YEAR_PATTERN.search(entries[-1]) is not None))
+            if starts_entry:
+                if marker:
+                    numbers.append(int(marker.group(1) or marker.group(2)))
+                    line = line[marker.end():]
+                entries.append(line)
+            elif entries[-1].endswith("-") and not entries[-1][-2:-1].isdigit():
+                # 断行处的连字符：单词拆行时去掉，页码范围等数字之间保留
+                entries[-1] = entries[-1][:-1] + line
+            elif entries[-1].endswith("-"):
+                entries[-1] += line
+            else:
+                entries[-1] += " " + line
+        sequential = numbers == list(range(numbers[0], numbers[0] + len(numbers))) if numbers else True
+        return entries, sequential
+
+    def split_reference(self, entry):
+        """从单条参考文献中分出题名和其余内容，返回 (题名, 其余内容, 置信度)"""
+        match = QUOTED_TITLE_PATTERN.search(entry)
+        if match and len(match.group(1).split()) >= 2:
+            return self.remove_title(entry, match.start(1), match.end(1)) + (1.0,)
+        # 作者-年份格式：年份紧跟在作者之后，题名在年份后面
+        match = TITLE_AFTER_YEAR_PATTERN.search(entry)
+        if match and match.start() <= len(entry) / 2 and len(match.group(1).split()) >= 2:
+            return self.remove_title(entry, match.start(1), match.end(1)) + (1.0,)
+        # 温哥华格式：作者. 题名. 期刊 年份
+        segments = re.split(r"(?<=[.?!])\s+", entry)
+        if (len(segments) >= 3 and len(segments[0].split()) <= 12 and len(segments[1].split()) >= 3
+                and YEAR_PATTERN.search(" ".join(segments[2:]))):
+            start = entry.index(segments[1], len(segments[0]))
+            return self.remove_title(entry, start, start + len(segments[1])) + (0.9,)
+        return "", entry, 0.4
+
+    def remove_title(self, entry, start, end):
+        title = entry[start:end].strip().rstrip(".,")
+        before = entry[:start].rstrip(" \"“")
+        after = entry[end:].lstrip(" .,\"”")
+        return title, (before + " " + after).strip()
+
+    def parse_references(self, text):
+        """返回 (参考文献列表, 置信度)；置信度为各条题名识别置信度的平均值，编号不连续时再降低"""
+        entries, sequential = self.split_reference_entries(text)
+        if not entries:
+            return [], 1.0
+        references = []
+        total = 0.0
+        for entry in entries:
+            paper_name, content, confidence = self.split_reference(entry)
+            # 出现多个年份通常是几条参考文献没有拆开
+            if len(YEAR_PATTERN.findall(entry)) > 2:
+                confidence = min(confidence, 0.4)
+            references.append({"paper_name": paper_name, "content": content})
+            total += confidence
+        confidence = total / len(entries)
+        if not sequential:
+            confidence *= 0.7
+        return references, confidence
+
+    def noise_ratio(self, text):
+        """非字母数字、非空白、非常规标点字符的比例"""
+        if not text:
+            return 0.0
+        noise = sum(1 for ch in text if not (ch.isalnum() or ch.isspace() or ch in ALLOWED_SYMBOLS))
+        return noise / len(text)
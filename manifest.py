@@ -0,0 +1,79 @@
+import hashlib
+import json
+import os
+
+
+def hash_text(text):
+    """计算文本内容的哈希"""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def manifest_path(output_file):
+    """输出文件对应的 manifest 路径，例如 paper.json -> paper.manifest.json"""
+    return os.path.splitext(output_file)[0] + ".manifest.json"
+
+
+def load_manifest(path):
+    """读取 manifest，不存在或已损坏时返回 None"""
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "r", encoding="utf-8") as file:
+            return json.load(file)
+    except ValueError:
+        return None
+
+
+def save_manifest(path, manifest):
+    """先写临时文件再替换，避免中断时留下不完整的 manifest"""
+    temp_path = path + ".tmp"
+    with open(temp_path, "w", encoding="utf-8") as file:
+        json.dump(manifest, file, ensure_ascii=False)
+    os.replace(temp_path, path)
+
+
+def build_task_entry(kind, chapter_range, chunk_result):
+    """记录一个 chunk 覆盖的章节范围，以及它在输出中贡献的 sections / references 数量"""
+    return {
+        "kind": kind,
+        "chapters": list(chapter_range),
+        "sections": len(chunk_result.get("sections") or []),
+        "references": len(chunk_result.get("references") or []) if kind == "final" else 0,
+    }
+
+
+def group_tasks(manifest):
+    """把共享章节的相邻 chunk（超长章节按段落拆分产生）归为一组，返回 [(章节哈希列表, chunk 序号列表)]"""
+    groups = []
+    for index, task in enumerate(manifest["tasks"]):
+        start, end = task["chapters"]
+        if groups and start <= groups[-1][1]:
+            groups[-1][1] = max(groups[-1][1], end)
+            groups[-1][2].append(index)
+        else:
+            groups.append([start, end, [index]])
+    return [(manifest["chapters"][start:end + 1], indices) for start, end, indices in groups]
+
+
+def split_existing_output(paper_metadata, manifest):
+    """按 manifest 中记录的数量把已有输出拆回每个 chunk 的结果；数量对不上时返回 None"""
+    sections = paper_metadata.get("sections") or []
+    references = paper_metadata.get("references") or []
+    if (sum(task["sections"] for task in manifest["tasks"]) != len(sections)
+            or sum(task["references"] for task in manifest["tasks"]) != len(references)):
+        return None
+
+    results = []
+    section_offset = 0
+    reference_offset = 0
+    for task in manifest["tasks"]:
+        result = {}
+        if task["kind"] == "first":
+            result = {key: value for key, value in paper_metadata.items() if key not in ("sections", "references")}
+        result["sections"] = sections[section_offset:section_offset + task["sections"]]
+        section_offset += task["sections"]
+        if task["kind"] == "final":
+            result["references"] = references[reference_offset:reference_offset + task["references"]]
+            reference_offset += task["references"]
+        results.append(result)
+    return results
@@ -2,166 +2,28 @@ import time
 import os
 import re
 import json
-import json5
-import copy
+import contextlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from openai import OpenAI
-
-class MDToJSONConverter:
-    def __init__(self, api_key, base_url, model):
-        self.client = OpenAI(
-            api_key=api_key,
-            base_url=base_url,
-            timeout=300
-        )
-        self.model = model
-        self.completion_tokens = 0
-        self.prompt_tokens = 0
-        
-
-    def read_md_file(self, file_path):
-        """读取 Markdown 文件内容"""
-        with open(file_path, "r", encoding="utf-8") as file:
-            return file.read()
-
-    def read_json_file(self, file_path):
-        """读取 JSON 文件内容"""
-        with open(file_path, "r", encoding="utf-8") as file:
-            return json.load(file)
-
-    def split_text_into_chunks_by_chapter(self, md_text):
-        """按章节（基于 # 标题）拆分 Markdown 文件"""
-        chunks = re.split(r"(?=^#{1,2} )", md_text, flags=re.MULTILINE)
-        chunks = [chunk.strip() for chunk in chunks if chunk.strip()]
-        return chunks
-
-    def remove_special_characters(self, output):
-        """移除特殊字符如 ```json 和 ```"""
-        output = output.replace("```json", "").replace("```", "").strip()
-        return output
-
-    def count_token_len(self, string):
-        # 首先判断是否包含中文
-        if re.search(r"[\u4e00-\u9fff]", string):
-            # 如果包含中文，直接返回字符串长度
-            return len(string)
-        else:
-            # 如果不包含中文，通过空格分割字符串
-            return len(string.split())
-    
-    def calculate_token_price(self, input_price, output_price):
-        """计算 token 价格"""
-        return (self.prompt_tokens / 1000) * input_price + (self.completion_tokens / 1000) * output_price
-
-    def get_segmented_chunks(self, chunks):
-        """根据章节拆分后的chunks，进一步拆分出first, then, final的chunks"""
-        first_chunk = ""
-        then_chunks = []
-        final_chunk = ""
-
-        # 处理first_chunk
-        while chunks and self.count_token_len(first_chunk + chunks[0]) <= 3000:
-            first_chunk += chunks.pop(0)
-
-        # 处理final_chunk
-        if len(chunks) >= 2:
-            final_chunk = chunks.pop() + chunks.pop()
-        elif len(chunks) == 1:
-            final_chunk = chunks.pop()
-        # final_chunk 可能很长，所以需要每3000字符分段处理
-        final_chunks = [final_chunk[i:i+3000] for i in range(0, self.count_token_len(final_chunk), 3000)]
-
-        # 处理then_chunks
-        current_chunk = ""
-        for chunk in chunks:
-            if self.count_token_len(current_chunk + chunk) <= 3000:
-                current_chunk += chunk
-            else:
-                if current_chunk:
-                    then_chunks.append(current_chunk)
-                current_chunk = chunk
-        if current_chunk:
-            then_chunks.append(current_chunk)
-
-        return first_chunk, then_chunks, final_chunks
-
-    def process_md_chunks(self, md_text, max_token=3000):
-        chunks = self.split_text_into_chunks_by_chapter(md_text)
-        first_chunk, then_chunks, final_chunks = self.get_segmented_chunks(chunks)
-        paper_metadata = {}
-        sections_metadata = []
-        previous_hierarchy = {'sections': []}
-
-        # 处理 first_chunk
-        if first_chunk:
-            chunk_result = self.process_single_chunk_first(first_chunk)
-            paper_metadata = {key: value for key, value in chunk_result.items() if key != 'sections'}
-            if 'sections' in chunk_result:
-                sections_metadata.extend(chunk_result['sections'])
-            previous_hierarchy = self.update_paper_structure(chunk_result, previous_hierarchy)
-            print("First chunk processed")
-            print(f"Updated paper_metadata: {paper_metadata}")
-
-        # 处理 then_chunks
-        for chunk in then_chunks:
-            chunk_result = self.process_single_chunk_then(chunk, previous_hierarchy)
-            if 'sections' in chunk_result:
-                sections_metadata.extend(chunk_result['sections'])
-            previous_hierarchy = self.update_paper_structure(chunk_result, previous_hierarchy)
-            print("Then chunk processed")
-            print(f"Updated paper_metadata: {paper_metadata}")
-
-        # 处理 final_chunks
-        if final_chunks:
-            for chunk in final_chunks:
-                chunk_result = self.process_single_chunk_final(chunk, previous_hierarchy)
-                if 'sections' in chunk_result:
-                    sections_metadata.extend(chunk_result['sections'])
-                previous_hierarchy = self.update_paper_structure(chunk_result, previous_hierarchy)
-                if 'references' in chunk_result:
-                    if 'references' not in paper_metadata:
-                        paper_metadata['references'] = []
-                    paper_metadata['references'].extend(chunk_result['references'])
-                print("Final chunk processed")
-                print(f"Final paper_metadata: {paper_metadata}")
-        
-        # 将sections_metadata添加到paper_metadata中
-        paper_metadata_items = list(paper_metadata.items())
-        paper_metadata_items.insert(-1, ('sections', sections_metadata))
-        paper_metadata = dict(paper_metadata_items)
-
-        return paper_metadata, previous_hierarchy
-
-    def call_openai_api(self, chunk, system_prompt):
-        max_retries = 3
-        retry_count = 0
-        while retry_count < max_retries:
-            try:
-                completion = self.client.chat.completions.create(
-                    model=self.model,
-                    messages=[
-                        {"role": "system", "content": system_prompt},
-                        {"role": "user", "content": chunk},
-                    ],
-                    temperature=0.0,
-                    timeout=300  # 设置300秒超时
-                )
-
-                completion_dict = completion.to_dict()
-                output = completion_dict["choices"][0]["message"]["content"]
-                self.prompt_tokens += completion_dict["usage"]["prompt_tokens"]
-                self.completion_tokens += completion_dict["usage"]["completion_tokens"]
-                return output
-            except Exception as e:
-                retry_count += 1
-                if retry_count == max_retries:
-                    raise Exception(f"OpenAI API 调用失败，已重试 {max_retries} 次：{str(e)}")
-                print(f"OpenAI API 调用失败，正在进行第 {retry_count} 次重试...")
-                time.sleep(2)  # 等待2秒后重试
-
-
-    def process_single_chunk_first(self, chunk):
-        """处理单个 chunk 并调用 OpenAI 生成 JSON 数据"""
-        system_prompt = f"""【Task Description】: Transform the OCR-scanned text of an academic paper into a structured JSON file. The text may include errors, formatting issues, and random encodings from images. Remove corrupted or unreadable text (i.e., non-ASCII characters or sequences that do not resemble meaningful words or sentences, including all mathematical formulas and tables).
+from llm_cache import LLMResponseCache
+from token_counter import get_tokenizer
+from stream_parser import IncrementalJSONParser
+from journal import ChunkJournal
+from manifest import (build_task_entry, group_tasks, hash_text, load_manifest, manifest_path, save_manifest,
+                      split_existing_output)
+from metrics import Metrics
+from preclean import MarkdownPreCleaner
+from rate_limiter import RateLimiter, backoff_delay, get_retry_after, is_rate_limit_error, is_retryable_error
+from section_tree import SectionTree, dump_paper
+from output_validator import normalize_chunk, normalize_elements, parse_json, salvage_json
+from local_parser import LocalStructureParser
+
+CONTINUE_PROMPT = "Your previous response was cut off. Continue exactly where it stopped, without repeating any text and without adding code fences or explanations."
+
+# 系统提示词不含任何变量，所有请求共享完全相同的前缀以命中服务商的提示词缓存；
+# 层级上下文和 chunk 文本放在 user 消息中
+FIRST_CHUNK_SYSTEM_PROMPT = """【Task Description】: Transform the OCR-scanned text of an academic paper into a structured JSON file. The text may include errors, formatting issues, and random encodings from images. Remove corrupted or unreadable text (i.e., non-ASCII characters or sequences that do not resemble meaningful words or sentences, including all mathematical formulas and tables).
         【Objective】: Create a JSON document that preserves all original text from the OCR-scanned paper, excluding any images, formulas, tables, or corrupted characters, while retaining paragraph segmentation and the hierarchical structure of sections and subsections. 
         For **each individual element** (e.g., heading, subheading, paragraph, or list item), classify it as one of the following categories: 'title', 'authors', 'abstract', 'keywords', or 'sections'. for sections, specify its content as 'heading', 'content', and 'subsections'. subsections also have the same format.
         【Steps to Follow】:
@@ -178,24 +40,15 @@ class MDToJSONConverter:
         - Only return valid JSON data for **each individual element**. Do not include any additional explanations or comments in the response.
         - Ensure the JSON structure is valid and properly formatted. Ensure the new JSON structure follows the same logical order as the original text.
         - Avoid any omissions in the content generated, ensuring the text is complete.
-        【Raw OCR-scanned text】:"""
-
-        output = self.call_openai_api(chunk, system_prompt)
-        output_cleaned = self.remove_special_characters(output)
-        print(f"Chunk 返回的内容: {output_cleaned}\n")
-        chunk_json = json5.loads(output_cleaned)
-
-        return chunk_json
+        【Input】: The user message contains the raw OCR-scanned text under 【Raw OCR-scanned text】."""
 
-
-    def process_single_chunk_then(self, chunk, previous_hierarchy):
-        system_prompt = f"""【Task Description】: Transform the OCR-scanned text of an academic paper into a structured JSON file. The text may include errors, formatting issues, and random encodings from images. Remove corrupted or unreadable text (i.e., non-ASCII characters or sequences that do not resemble meaningful words or sentences, including all mathematical formulas and tables).
+THEN_CHUNK_SYSTEM_PROMPT = """【Task Description】: Transform the OCR-scanned text of an academic paper into a structured JSON file. The text may include errors, formatting issues, and random encodings from images. Remove corrupted or unreadable text (i.e., non-ASCII characters or sequences that do not resemble meaningful words or sentences, including all mathematical formulas and tables).
         【Objective】: Create a JSON document that preserves all original text from the OCR-scanned paper, excluding any images, formulas, tables, or corrupted characters, while retaining paragraph segmentation and the hierarchical structure of sections and subsections. 
         For **each section or subsection**:
         1. **Text Cleaning**: Remove corrupted characters, non-ASCII symbols, artifacts from images, formulas, and tables, without altering valid textual content.
         2. **Classification**: For **each section or subsection**, classify it into one of the following keys: 'heading', 'content', 'subsections'. Ensure the text from each element is preserved in the final JSON.
         3. **Segmentation**: Detect and preserve paragraphs, sections, and subsections based on structural and formatting cues (e.g., blank lines, indentation).
-        4. **Hierarchy Identification**: Ensure the new section hierarchical structure is consistent with the previously generated hierarchy {previous_hierarchy}. 
+        4. **Hierarchy Identification**: Ensure the new section hierarchical structure is consistent with the previously generated hierarchy, given as a numbered outline of earlier headings under 【Previously generated hierarchy】 in the user message. 
         5. **JSON Conversion**: Convert the cleaned and classified text into JSON format, set the key followed by these categories: 'heading', 'content', 'subsections'. For headings and contents, the value is a string. for subsections, the value is a list of dictionaries with the keys: 'heading', 'content', 'subsections'. subsections also have the same format.
         **For sections**:
         1. Clearly indicate whether it is a **heading** or **content** or **subsections**.
@@ -207,25 +60,15 @@ class MDToJSONConverter:
         - Ensure the JSON structure is valid and properly formatted. Ensure the new JSON structure follows the same logical order as the original text.
         - Avoid any omissions in the content generated, ensuring the text is complete.
         - **Do not generate or classify any text as 'title'. Only classify as 'heading', 'content', or 'subsections'.**
-        【Raw OCR-scanned text】: """
-
-        output = self.call_openai_api(chunk, system_prompt)
-        output_cleaned = self.remove_special_characters(output)
-        print(f"Chunk 返回的内容: {output_cleaned}\n")
-        chunk_json = json5.loads(output_cleaned)
-
-        return chunk_json
+        【Input】: The user message contains the raw OCR-scanned text under 【Raw OCR-scanned text】."""
 
-
-    # todo
-    def process_single_chunk_final(self, chunk, previous_hierarchy):
-        system_prompt = f"""【Task Description】: Convert OCR-scanned text from an academic paper's sections into a structured JSON file. The text may contain errors, formatting issues, and random encodings. Your task is to **remove any corrupted or unreadable text** (i.e., non-ASCII characters or sequences that do not resemble meaningful words or sentences, including mathematical formulas and tables).
+FINAL_CHUNK_SYSTEM_PROMPT = """【Task Description】: Convert OCR-scanned text from an academic paper's sections into a structured JSON file. The text may contain errors, formatting issues, and random encodings. Your task is to **remove any corrupted or unreadable text** (i.e., non-ASCII characters or sequences that do not resemble meaningful words or sentences, including mathematical formulas and tables).
         【Objective】: Create a JSON document that preserves all original text from the OCR-scanned paper, excluding any images, formulas, tables, or corrupted characters, while retaining paragraph segmentation and the hierarchical structure of sections and subsections. 
         For **each section or subsection**:
         1. **Text Cleaning**: Remove corrupted characters, non-ASCII symbols, artifacts from images, formulas, and tables, without altering valid textual content.
         2. **Classification**: For **each section or subsection**, classify it into one of the following keys: 'heading', 'content', 'subsections'. Ensure the text from each element is preserved in the final JSON.
         3. **Segmentation**: Detect and preserve paragraphs, sections, and subsections based on structural and formatting cues (e.g., blank lines, indentation).
-        4. **Hierarchy Identification**: Ensure the new section hierarchical structure is consistent with the previously generated hierarchy {previous_hierarchy}. 
+        4. **Hierarchy Identification**: Ensure the new section hierarchical structure is consistent with the previously generated hierarchy, given as a numbered outline of earlier headings under 【Previously generated hierarchy】 in the user message. 
         5. **JSON Conversion**: Convert the cleaned and classified text into JSON format, set the key followed by these categories: 'heading', 'content', 'subsections'. For headings and contents, the value is a string. for subsections, the value is a list of dictionaries with the keys: 'heading', 'content', 'subsections'. subsections also have the same format.
         **For sections**:
         1. Clearly indicate whether it is a **heading** or **content** or **subsections**.
@@ -235,7 +78,7 @@ class MDToJSONConverter:
         1. **Keep Right Hierarchy**: The reference should be placed under the `'references'` field, even if the chunk does not contain any sections.
         2. **Paper Name Extraction**: Extract the **title** of the referenced paper and classify it under the `'paper_name'` field.
         3. **Content Preservation**: Place the remaining content of the reference (authors, publication year, journal name, etc.) under the `'content'` field.
-        4. **JSON Conversion**: Convert the cleaned references text into a JSON object as the following format:"""+"""
+        4. **JSON Conversion**: Convert the cleaned references text into a JSON object as the following format:
         {
            "references": [
                 {
@@ -256,51 +99,774 @@ class MDToJSONConverter:
         - Only return valid JSON data for **each individual element**. Do not include any additional explanations or comments in the response.
         - Ensure the JSON structure is valid and properly formatted. Ensure the new JSON structure follows the same logical order as the original text.
         - Avoid any omissions in the content generated, ensuring the text is complete.
-        **Raw OCR-scanned text**: """
+        【Input】: The user message contains the raw OCR-scanned text under 【Raw OCR-scanned text】."""
+
+REPAIR_SYSTEM_PROMPT = """【Task Description】: Repair one broken fragment of the JSON produced while converting an academic paper into structured JSON. The fragment may be malformed, truncated, or may not follow the schema below.
+        【Schema】:
+        - A section is an object with the keys 'heading' (string), 'content' (string) and 'subsections' (a list of sections in the same format).
+        - A reference is an object with the keys 'paper_name' (the title of the referenced paper) and 'content' (the remaining content of the reference: authors, publication year, journal name, etc.).
+        【Important】:
+        - Only return a JSON array containing the repaired element(s) of the kind named under 【Field】 ('sections' or 'references'). Do not include any additional explanations or comments in the response.
+        - Keep all text from the fragment and do not invent new text. If the fragment is truncated, end it after the last complete sentence.
+        【Input】: The user message contains the field name under 【Field】, the problem under 【Problem】 and the broken fragment under 【Broken fragment】."""
+
+
+class MDToJSONConverter:
+    def __init__(self, api_key, base_url, model, client=None, request_semaphore=None, cache=None,
+                 compact_hierarchy=True, hierarchy_max_siblings=5, hierarchy_token_budget=500,
+                 tokenizer="heuristic", stream=False, on_stream_element=None, metrics=None, verbose=False,
+                 rate_limiter=None, max_retries=3, preclean=None, max_repairs=5, local_parse=False,
+                 local_confidence=0.8):
+        # 批量处理时可传入共享的 client（复用连接池）和全局并发请求上限
+        self.client = client or OpenAI(
+            api_key=api_key,
+            base_url=base_url,
+            timeout=300,
+            max_retries=0  # 重试统一由 call_openai_api 处理
+        )
+        self.request_semaphore = request_semaphore
+        # 可选的 LLMResponseCache，命中时不发起请求也不计入 token
+        self.cache = cache
+        self.model = model
+        self.completion_tokens = 0
+        self.prompt_tokens = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        # 层级上下文以编号大纲形式写入提示词，并按窗口策略控制在 token 预算内
+        self.compact_hierarchy = compact_hierarchy
+        self.hierarchy_max_siblings = hierarchy_max_siblings
+        self.hierarchy_token_budget = hierarchy_token_budget
+        self.hierarchy_tokens_saved = 0
+        # 分词器可选 "heuristic" / "tiktoken" 或 BaseTokenizer 实例，计数结果带缓存
+        self.tokenizer = get_tokenizer(tokenizer)
+        # 旧版 dict 大纲中每个章节除标题外的固定开销，用于估算紧凑大纲节省的 token 数
+        self.legacy_entry_tokens = (self.count_token_len("{'heading': 'a', 'subsections': []}, ")
+                                    - self.count_token_len("a"))
+        # 流式模式：sections / references 元素一闭合就回调 on_stream_element(key, element)
+        self.stream = stream
+        self.on_stream_element = on_stream_element
+        self.first_section_latencies = []
+        self.resumed_chunks = 0
+        self.reused_chunks = 0
+        self.reprocessed_chunks = 0
+        # 批量处理时可共享同一个 Metrics；verbose 时打印每个 chunk 的模型原始输出
+        self.metrics = metrics or Metrics()
+        self.verbose = verbose
+        # 同一服务商的所有 converter 共享一个 RateLimiter
+        self.rate_limiter = rate_limiter
+        self.max_retries = max_retries
+        # 本地预清理模式："conservative" / "strict"，None 表示不清理
+        self.preclean = preclean
+        self.preclean_stats = {}
+        # 系统提示词在构造时确定，之后每次请求都使用同一个字符串
+        self.system_prompts = {
+            'first': FIRST_CHUNK_SYSTEM_PROMPT,
+            'then': THEN_CHUNK_SYSTEM_PROMPT,
+            'final': FINAL_CHUNK_SYSTEM_PROMPT,
+        }
+        self.cached_prompt_tokens = 0
+        # 模型输出先严格解析、失败再宽松解析并按 schema 校验；每个 chunk 最多单独修复 max_repairs 个损坏片段
+        self.max_repairs = max_repairs
+        self.parse_stats = {}
+        # 本地结构解析：置信度不低于 local_confidence 的 chunk 直接由 Markdown 结构生成结果，不调用 LLM
+        self.local_parser = LocalStructureParser(preclean) if local_parse else None
+        self.local_confidence = local_confidence
+        self.local_chunks = 0
+        self.llm_chunks = 0
+        # 并发模式下多个线程会同时累加 token 计数
+        self._lock = threading.Lock()
+
+
+    def read_md_file(self, file_path):
+        """读取 Markdown 文件内容"""
+        with open(file_path, "r", encoding="utf-8") as file:
+            return file.read()
+
+    def read_json_file(self, file_path):
+        """读取 JSON 文件内容"""
+        with open(file_path, "r", encoding="utf-8") as file:
+            return json.load(file)
+
+    def split_text_into_chunks_by_chapter(self, md_text):
+        """按章节（基于 # 标题）拆分 Markdown 文件"""
+        chunks = re.split(r"(?=^#{1,2} )", md_text, flags=re.MULTILINE)
+        chunks = [chunk.strip() for chunk in chunks if chunk.strip()]
+        return chunks
+
+    def extract_headings(self, md_text):
+        """提取 # 和 ## 标题，返回 (层级, 标题文本) 列表"""
+        return [(len(m.group(1)), m.group(2).strip())
+                for m in re.finditer(r"^(#{1,2}) (.+)$", md_text, flags=re.MULTILINE)]
+
+    def extract_body_headings(self, first_chunk):
+        """提取第一个 chunk 中的章节标题：第一个 # 标题是论文题目，串行模式下模型会把它归为 title 而不是章节，这里同样跳过"""
+        headings = self.extract_headings(first_chunk)
+        if headings and headings[0][0] == 1:
+            headings = headings[1:]
+        return headings
+
+    def build_heading_skeleton(self, headings):
+        """根据本地标题列表构建只含标题的章节树"""
+        sections = []
+        for level, heading in headings:
+            node = {'heading': heading, 'subsections': []}
+            if level == 2 and sections:
+                sections[-1]['subsections'].append(node)
+            else:
+                sections.append(node)
+        return SectionTree(sections)
+
+    def remove_special_characters(self, output):
+        """移除特殊字符如 ```json 和 ```"""
+        output = output.replace("```json", "").replace("```", "").strip()
+        return output
+
+    def count_token_len(self, string):
+        """使用当前分词器计算 token 数"""
+        return self.tokenizer.count(string)
+
+    def window_hierarchy(self, entries):
+        """保留当前位置的祖先及每一层最近的 N 个兄弟章节，再按 token 预算从最早的章节开始裁剪"""
+        if not entries:
+            return entries, 0
+        current = entries[-1][0]
+        ancestor_prefixes = {current[:depth] for depth in range(len(current))}
+        ancestors = {current[:depth] for depth in range(1, len(current) + 1)}
+
+        # 每个祖先下的子章节编号最大值，用于判断是否属于最近的 N 个兄弟
+        last_child = {}
+        for number, _ in entries:
+            parent = number[:-1]
+            if parent in ancestor_prefixes:
+                last_child[parent] = max(last_child.get(parent, 0), number[-1])
+
+        kept = [(number, heading) for number, heading in entries
+                if number[:-1] in ancestor_prefixes
+                and number[-1] > last_child[number[:-1]] - self.hierarchy_max_siblings]
+
+        while (len(kept) > len(ancestors)
+               and self.count_token_len(self.format_outline(kept)) > self.hierarchy_token_budget):
+            for i, (number, _) in enumerate(kept):
+                if number not in ancestors:
+                    del kept[i]
+                    break
+        return kept, len(entries) - len(kept)
+
+    def format_outline(self, entries, omitted=0):
+        """将 (编号元组, 标题) 列表格式化为带编号的缩进大纲"""
+        lines = []
+        if omitted:
+            lines.append(f"... ({omitted} earlier headings omitted)")
+        for number, heading in entries:
+            lines.append("  " * (len(number) - 1) + ".".join(map(str, number)) + " " + heading)
+        return "\n".join(lines)
+
+    def render_hierarchy(self, previous_hierarchy):
+        """生成写入提示词的层级上下文，并统计相对 dict 形式节省的 token 数"""
+        if not self.compact_hierarchy:
+            return str(previous_hierarchy.outline())
+        entries, omitted = self.window_hierarchy(previous_hierarchy.entries)
+        outline = self.format_outline(entries, omitted)
+        saved = self.legacy_hierarchy_tokens(previous_hierarchy) - self.count_token_len(outline)
+        with self._lock:
+            self.hierarchy_tokens_saved += max(saved, 0)
+        return outline
+
+    def legacy_hierarchy_tokens(self, hierarchy):
+        """估算旧版 dict 大纲的 token 数（标题加每个章节的固定开销），只累计上次统计之后新增的章节，不生成完整大纲"""
+        counted, tokens = hierarchy.legacy_tokens
+        for _, heading in hierarchy.entries[counted:]:
+            tokens += self.count_token_len(heading) + self.legacy_entry_tokens
+        hierarchy.legacy_tokens = [len(hierarchy.entries), tokens]
+        return tokens
+
+    def calculate_token_price(self, input_price, output_price, cached_input_price=None):
+        """计算 token 价格；命中提示词缓存的输入 token 按 cached_input_price 计价"""
+        if cached_input_price is None:
+            cached_input_price = input_price
+        uncached_prompt_tokens = self.prompt_tokens - self.cached_prompt_tokens
+        return ((uncached_prompt_tokens / 1000) * input_price + (self.cached_prompt_tokens / 1000) * cached_input_price
+                + (self.completion_tokens / 1000) * output_price)
+
+    def split_section_units(self, sections, max_token, start=0):
+        """将章节转为 (文本, token数, 章节序号) 单元；超出预算的章节按段落拆分，不会从段落中间切开"""
+        units = []
+        for chapter, section in enumerate(sections, start):
+            tokens = self.count_token_len(section)
+            if tokens <= max_token:
+                units.append((section, tokens, chapter))
+                continue
+            for paragraph in re.split(r"\n\s*\n", section):
+                paragraph = paragraph.strip()
+                if paragraph:
+                    units.append((paragraph, self.count_token_len(paragraph), chapter))
+        return units
+
+    def pack_units(self, units, max_token):
+        """单次遍历，把连续单元打包成不超过 max_token 的 chunk（单个超长段落单独成块），返回 (文本, (首章节, 末章节)) 列表"""
+        packs = []
+        current = []
+        current_tokens = 0
+        for text, tokens, chapter in units:
+            if current and current_tokens + tokens > max_token:
+                packs.append(("\n\n".join(unit[0] for unit in current), (current[0][2], current[-1][2])))
+                current = []
+                current_tokens = 0
+            current.append((text, tokens, chapter))
+            current_tokens += tokens
+        if current:
+            packs.append(("\n\n".join(unit[0] for unit in current), (current[0][2], current[-1][2])))
+        return packs
+
+    def segment_chapters(self, chunks, max_token=3000):
+        """根据章节拆分后的chunks，按顺序拆分出 (类型, chunk, 章节范围) 任务"""
+        # 处理first_chunk：尽量多地放入开头的完整章节，至少包含第一个章节
+        first_count = 0
+        first_tokens = 0
+        for chunk in chunks:
+            tokens = self.count_token_len(chunk)
+            if first_count and first_tokens + tokens > max_token:
+                break
+            first_tokens += tokens
+            first_count += 1
+        first_packs = self.pack_units(self.split_section_units(chunks[:first_count], max_token), max_token)
+
+        # 处理final_chunk：剩余章节中的最后两个（通常包含参考文献）
+        final_start = max(first_count, len(chunks) - 2)
+        final_packs = self.pack_units(self.split_section_units(chunks[final_start:], max_token, final_start), max_token)
+
+        # 处理then_chunks：第一个章节超长时多出来的部分也在这里处理
+        then_packs = first_packs[1:] + self.pack_units(
+            self.split_section_units(chunks[first_count:final_start], max_token, first_count), max_token)
+
+        tasks = [('first', *first_packs[0])] if first_packs else []
+        tasks.extend(('then', *pack) for pack in then_packs)
+        tasks.extend(('final', *pack) for pack in final_packs)
+        return tasks
+
+    def plan_chunk_tasks(self, md_text, max_token):
+        """拆分章节并按文档顺序列出 (类型, chunk, 章节范围) 任务，返回 (章节列表, 任务列表)"""
+        if self.preclean:
+            md_text = self.preclean_md_text(md_text)
+        with self.metrics.timer("chunking"):
+            chapters = self.split_text_into_chunks_by_chapter(md_text)
+            tasks = self.segment_chapters(chapters, max_token)
+        for kind, chunk, _ in tasks:
+            self.metrics.observe("chunk_tokens", self.count_token_len(chunk), kind=kind)
+        return chapters, tasks
+
+    def preclean_md_text(self, md_text):
+        """在拆分之前移除图片、公式、表格、HTML 块和乱码，并累计各规则的清理统计"""
+        cleaner = MarkdownPreCleaner(self.preclean, count_tokens=self.count_token_len)
+        with self.metrics.timer("preclean"):
+            md_text = cleaner.clean(md_text)
+        with self._lock:
+            for rule, stats in cleaner.stats.items():
+                total = self.preclean_stats.setdefault(rule, {"matches": 0, "bytes": 0, "tokens": 0})
+                for key, value in stats.items():
+                    total[key] += value
+        for rule, stats in cleaner.stats.items():
+            self.metrics.inc("preclean_removed_bytes_total", stats["bytes"], rule=rule)
+            self.metrics.inc("preclean_removed_tokens_total", stats["tokens"], rule=rule)
+        return md_text
+
+    def process_chunk(self, kind, chunk, previous_hierarchy):
+        """按 chunk 类型调用对应的处理方法；启用本地解析且置信度足够时不调用 LLM"""
+        if self.local_parser:
+            with self.metrics.timer("local_parse"):
+                result, confidence, reasons = self.local_parser.parse(kind, chunk)
+            self.metrics.observe("local_parse_confidence", confidence, kind=kind)
+            if confidence >= self.local_confidence:
+                with self._lock:
+                    self.local_chunks += 1
+                self.metrics.inc("chunks_total", kind=kind, path="local")
+                return result
+            if self.verbose:
+                print(f"本地解析置信度 {confidence:.2f}，改用 LLM: {'; '.join(reasons)}")
+        with self._lock:
+            self.llm_chunks += 1
+        self.metrics.inc("chunks_total", kind=kind, path="llm")
+        if kind == 'first':
+            return self.process_single_chunk_first(chunk)
+        if kind == 'then':
+            return self.process_single_chunk_then(chunk, previous_hierarchy)
+        return self.process_single_chunk_final(chunk, previous_hierarchy)
+
+    def merge_chunk_result(self, kind, chunk_result, paper_metadata, sections_metadata):
+        """把单个 chunk 的结果合并进 paper_metadata 和章节树 sections_metadata"""
+        if kind == 'first':
+            paper_metadata = {key: value for key, value in chunk_result.items() if key != 'sections'}
+        if 'sections' in chunk_result:
+            sections_metadata.extend(chunk_result['sections'])
+        if kind == 'final' and 'references' in chunk_result:
+            if 'references' not in paper_metadata:
+                paper_metadata['references'] = []
+            paper_metadata['references'].extend(chunk_result['references'])
+        return paper_metadata
+
+    def finalize_paper_metadata(self, paper_metadata, sections_metadata):
+        """将sections_metadata添加到paper_metadata中，位于最后一个字段之前；章节树转为普通列表，结果可直接用 json 序列化"""
+        last_item = paper_metadata.popitem() if paper_metadata else None
+        paper_metadata['sections'] = sections_metadata.to_list()
+        if last_item:
+            paper_metadata[last_item[0]] = last_item[1]
+        return paper_metadata
+
+    def process_md_chunks(self, md_text, max_token=3000, journal=None, manifest=None):
+        chapters, tasks = self.plan_chunk_tasks(md_text, max_token)
+        if manifest is not None:
+            manifest['chapters'] = [hash_text(chapter) for chapter in chapters]
+        paper_metadata = {}
+        # 已合并的章节本身就是后续 chunk 的层级上下文，大纲随章节追加增量维护
+        sections_metadata = SectionTree()
+
+        # 串行模式下后面的 chunk 依赖前面的层级，只能复用日志中连续完成的前缀
+        completed = journal.load() if journal else {}
+        resuming = True
+        for index, (kind, chunk, chapter_range) in enumerate(tasks):
+            record = completed.get(index)
+            if resuming and journal and journal.matches(record, kind, chunk):
+                chunk_result = record['result']
+                with self._lock:
+                    self.resumed_chunks += 1
+            else:
+                resuming = False
+                chunk_result = self.process_chunk(kind, chunk, sections_metadata)
+                if journal:
+                    journal.append(index, kind, chunk, chunk_result)
+            with self.metrics.timer("update_structure"):
+                paper_metadata = self.merge_chunk_result(kind, chunk_result, paper_metadata, sections_metadata)
+            if manifest is not None:
+                manifest['tasks'].append(build_task_entry(kind, chapter_range, chunk_result))
+            print(f"{kind.capitalize()} chunk processed ({index + 1}/{len(tasks)})")
+
+        paper_metadata = self.finalize_paper_metadata(paper_metadata, sections_metadata)
+
+        return paper_metadata, sections_metadata.outline()
+
+    def process_md_chunks_concurrent(self, md_text, max_token=3000, max_workers=4, journal=None, manifest=None):
+        """并发处理所有 chunk：用本地标题框架代替上一轮 LLM 返回的层级，结果按文档顺序合并"""
+        chapters, planned_tasks = self.plan_chunk_tasks(md_text, max_token)
+        if manifest is not None:
+            manifest['chapters'] = [hash_text(chapter) for chapter in chapters]
+        tasks = []
+        # 每个 chunk 的层级上下文只包含它之前出现的标题，与串行模式一致
+        headings = []
+        for index, (kind, chunk, _) in enumerate(planned_tasks):
+            tasks.append((index, kind, chunk, self.build_heading_skeleton(headings)))
+            headings.extend(self.extract_body_headings(chunk) if index == 0 else self.extract_headings(chunk))
+
+        # 各 chunk 的上下文由本地标题决定，日志中任意已完成的 chunk 都可以复用
+        completed = journal.load() if journal else {}
+
+        def run(task):
+            index, kind, chunk, skeleton = task
+            record = completed.get(index)
+            if journal and journal.matches(record, kind, chunk):
+                with self._lock:
+                    self.resumed_chunks += 1
+                return record['result']
+            result = self.process_chunk(kind, chunk, skeleton)
+            if journal:
+                journal.append(index, kind, chunk, result)
+            print(f"{kind.capitalize()} chunk processed")
+            return result
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(run, tasks))
+
+        # 按文档顺序合并，合并方式与 process_md_chunks 相同
+        paper_metadata = {}
+        sections_metadata = SectionTree()
+        for (kind, _, chapter_range), chunk_result in zip(planned_tasks, results):
+            with self.metrics.timer("update_structure"):
+                paper_metadata = self.merge_chunk_result(kind, chunk_result, paper_metadata, sections_metadata)
+            if manifest is not None:
+                manifest['tasks'].append(build_task_entry(kind, chapter_range, chunk_result))
+
+        paper_metadata = self.finalize_paper_metadata(paper_metadata, sections_metadata)
+
+        return paper_metadata, sections_metadata.outline()
+
+    def process_md_chunks_incremental(self, md_text, existing_metadata, old_manifest, max_token=3000, max_workers=4,
+                                      manifest=None):
+        """增量转换：内容未变的章节直接复用已有输出，只把变化的章节发送给 LLM；已有输出无法对齐时返回 None"""
+        old_results = split_existing_output(existing_metadata, old_manifest)
+        if old_results is None:
+            return None
+        if self.preclean:
+            md_text = self.preclean_md_text(md_text)
+        chapters = self.split_text_into_chunks_by_chapter(md_text)
+        hashes = [hash_text(chapter) for chapter in chapters]
+        groups = group_tasks(old_manifest)
+
+        # 逐章节与旧的 chunk 组对齐：能整体匹配的组直接复用，其余连续章节归为需要重新处理的片段
+        # segments 中每项为 (首章节, 末章节之后, 复用的组序号或 None)
+        segments = []
+        used_groups = set()
+        pending_start = None
+        i = 0
+        while i < len(chapters):
+            match = next((g for g, (group_hashes, _) in enumerate(groups)
+                          if g not in used_groups and hashes[i:i + len(group_hashes)] == group_hashes), None)
+            if match is None:
+                if pending_start is None:
+                    pending_start = i
+                i += 1
+                continue
+            if pending_start is not None:
+                segments.append((pending_start, i, None))
+                pending_start = None
+            segments.append((i, i + len(groups[match][0]), match))
+            used_groups.add(match)
+            i += len(groups[match][0])
+        if pending_start is not None:
+            segments.append((pending_start, len(chapters), None))
+
+        first_reused = any(old_manifest['tasks'][groups[group][1][0]]['kind'] == 'first'
+                           for _, _, group in segments if group is not None)
+        plan = []
+        for position, (start, end, group) in enumerate(segments):
+            if group is not None:
+                group_start = old_manifest['tasks'][groups[group][1][0]]['chapters'][0]
+                for task_index in groups[group][1]:
+                    old_task = old_manifest['tasks'][task_index]
+                    chapter_range = tuple(chapter + start - group_start for chapter in old_task['chapters'])
+                    plan.append((old_task['kind'], None, chapter_range, old_results[task_index]))
+                continue
+            # 变化的片段：位于开头且旧的首个 chunk 未被复用时按 first 处理，位于末尾或参考文献之前按 final 处理
+            next_segment = segments[position + 1] if position + 1 < len(segments) else None
+            if next_segment is None or old_manifest['tasks'][groups[next_segment[2]][1][0]]['kind'] == 'final':
+                kind = 'final'
+            else:
+                kind = 'then'
+            packs = self.pack_units(self.split_section_units(chapters[start:end], max_token, start), max_token)
+            for pack_index, (chunk, chapter_range) in enumerate(packs):
+                pack_kind = 'first' if start == 0 and pack_index == 0 and not first_reused else kind
+                plan.append((pack_kind, chunk, chapter_range, None))
+
+        # 需要重新处理的 chunk 并发执行，层级上下文使用它之前所有章节的本地标题
+        chapter_headings = [self.extract_body_headings(chapter) if index == 0 else self.extract_headings(chapter)
+                            for index, chapter in enumerate(chapters)]
+
+        def run(task):
+            kind, chunk, chapter_range, _ = task
+            headings = [heading for chapter in chapter_headings[:chapter_range[0]] for heading in chapter]
+            result = self.process_chunk(kind, chunk, self.build_heading_skeleton(headings))
+            print(f"{kind.capitalize()} chunk reprocessed")
+            return result
+
+        new_tasks = [task for task in plan if task[3] is None]
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            new_results = iter(list(executor.map(run, new_tasks)))
+        with self._lock:
+            self.reused_chunks += len(plan) - len(new_tasks)
+            self.reprocessed_chunks += len(new_tasks)
+
+        paper_metadata = {}
+        sections_metadata = SectionTree()
+        if manifest is not None:
+            manifest['chapters'] = hashes
+        for kind, _, chapter_range, old_result in plan:
+            chunk_result = old_result if old_result is not None else next(new_results)
+            paper_metadata = self.merge_chunk_result(kind, chunk_result, paper_metadata, sections_metadata)
+            if manifest is not None:
+                manifest['tasks'].append(build_task_entry(kind, chapter_range, chunk_result))
+
+        return self.finalize_paper_metadata(paper_metadata, sections_metadata)
 
-        output = self.call_openai_api(chunk, system_prompt)
+    def call_openai_api(self, chunk, system_prompt):
+        cache_key = None
+        if self.cache:
+            cache_key = self.cache.make_key(self.model, system_prompt, chunk)
+            output = self.cache.get(cache_key)
+            with self._lock:
+                if output is not None:
+                    self.cache_hits += 1
+                else:
+                    self.cache_misses += 1
+            if output is not None:
+                return output
+
+        # 流式请求中断后，重试时从已收到的内容续写而不是从头开始；同时记录本次调用的 token 用量
+        stream_state = {"parts": [], "parser": IncrementalJSONParser(), "start_time": time.time(), "first_section": False,
+                        "tokens": 0}
+        # 预估本次请求的 token 数：提示词 + 与 chunk 大致等长的输出
+        estimated_tokens = self.count_token_len(system_prompt) + 2 * self.count_token_len(chunk)
+        max_retries = self.max_retries
+        retry_count = 0
+        while retry_count < max_retries:
+            try:
+                if self.rate_limiter:
+                    self.rate_limiter.acquire(estimated_tokens)
+                tokens_before = stream_state["tokens"]
+                with self.request_semaphore or contextlib.nullcontext(), \
+                        self.metrics.timer("llm_request", model=self.model):
+                    if self.stream:
+                        output = self.stream_chat_completion(chunk, system_prompt, stream_state)
+                    else:
+                        completion = self.client.chat.completions.create(
+                            model=self.model,
+                            messages=[
+                                {"role": "system", "content": system_prompt},
+                                {"role": "user", "content": chunk},
+                            ],
+                            temperature=0.0,
+                            timeout=300  # 设置300秒超时
+                        )
+
+                        completion_dict = completion.to_dict()
+                        output = completion_dict["choices"][0]["message"]["content"]
+                        usage = completion_dict["usage"]
+                        self.add_usage(usage["prompt_tokens"], usage["completion_tokens"], stream_state,
+                                       (usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0)
+                if self.rate_limiter:
+                    self.rate_limiter.record_usage(estimated_tokens, stream_state["tokens"] - tokens_before)
+                    self.rate_limiter.on_success()
+                if cache_key:
+                    self.cache.put(cache_key, output)
+                return output
+            except Exception as e:
+                retry_count += 1
+                self.metrics.inc("llm_errors_total", model=self.model, error=type(e).__name__)
+                if not is_retryable_error(e):
+                    raise Exception(f"OpenAI API 调用失败，错误不可重试：{str(e)}") from e
+                if retry_count == max_retries:
+                    raise Exception(f"OpenAI API 调用失败，已重试 {max_retries} 次：{str(e)}")
+                retry_after = get_retry_after(e)
+                if is_rate_limit_error(e):
+                    self.metrics.inc("llm_rate_limited_total", model=self.model)
+                    if self.rate_limiter:
+                        self.rate_limiter.on_rate_limited(retry_after)
+                delay = retry_after if retry_after is not None else backoff_delay(retry_count)
+                print(f"OpenAI API 调用失败，{delay:.1f} 秒后进行第 {retry_count} 次重试...")
+                self.metrics.inc("llm_retries_total", model=self.model)
+                time.sleep(delay)
+
+    def add_usage(self, prompt_tokens, completion_tokens, stream_state, cached_tokens=0):
+        """累加 API 返回的 token 用量，stream_state 中记录本次调用的用量；cached_tokens 为命中提示词缓存的部分"""
+        stream_state["tokens"] += prompt_tokens + completion_tokens
+        with self._lock:
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += completion_tokens
+            self.cached_prompt_tokens += cached_tokens
+        self.metrics.inc("llm_prompt_tokens_total", prompt_tokens, model=self.model)
+        self.metrics.inc("llm_cached_prompt_tokens_total", cached_tokens, model=self.model)
+        self.metrics.inc("llm_completion_tokens_total", completion_tokens, model=self.model)
+
+    def count_parse_stat(self, name, value=1):
+        with self._lock:
+            self.parse_stats[name] = self.parse_stats.get(name, 0) + value
+
+    def parse_chunk_output(self, output, kind):
+        """清理模型输出，先严格解析、失败再用 json5 解析，整体仍无法解析时抢救已闭合的元素；
+        按 schema 校验后返回 (结果, 需要模型修复的问题列表)，完全无法恢复时抛出 ValueError"""
         output_cleaned = self.remove_special_characters(output)
-        print(f"Chunk 返回的内容: {output_cleaned}\n")
-        chunk_json = json5.loads(output_cleaned)
+        if self.verbose:
+            print(f"Chunk 返回的内容: {output_cleaned}\n")
+        with self.metrics.timer("json_parse", model=self.model):
+            try:
+                result, parser = parse_json(output_cleaned)
+            except ValueError:
+                result, parser = salvage_json(output_cleaned), "salvage"
+        self.count_parse_stat(parser)
+        self.metrics.inc("json_parse_total", model=self.model, parser=parser)
+        with self.metrics.timer("json_validate", model=self.model):
+            result, coerced, problems = normalize_chunk(kind, result)
+        if coerced:
+            self.count_parse_stat("coerced", coerced)
+            self.metrics.inc("json_coerced_fields_total", coerced, model=self.model)
+        return result, problems
+
+    def request_chunk_json(self, kind, user_message):
+        """请求模型转换一个 chunk；损坏的片段单独发回模型修复，整体无法恢复时删除缓存的响应后抛出异常"""
+        system_prompt = self.system_prompts[kind]
+        output = self.call_openai_api(user_message, system_prompt)
+        try:
+            chunk_json, problems = self.parse_chunk_output(output, kind)
+            if len(problems) > self.max_repairs:
+                raise ValueError(f"需要修复的片段过多 ({len(problems)} 个)")
+        except ValueError as e:
+            self.discard_cached_response(user_message, system_prompt)
+            self.metrics.inc("json_chunk_failures_total", model=self.model)
+            raise ValueError(f"{kind} chunk 的输出无法解析: {e}")
+
+        # 损坏的元素替换为修复结果（可能是 0 个或多个元素），其余元素保持原位
+        replacements = {(key, index): self.repair_fragment(key, fragment, reason)
+                        for key, index, fragment, reason in problems}
+        for key in {key for key, _ in replacements}:
+            chunk_json[key] = [item for index, element in enumerate(chunk_json[key])
+                               for item in replacements.get((key, index), [element])]
+        return chunk_json
+
+    def discard_cached_response(self, user_message, system_prompt):
+        """删除无法使用的模型响应的缓存，下次运行时重新请求"""
+        if self.cache:
+            self.cache.delete(self.cache.make_key(self.model, system_prompt, user_message))
+
+    def repair_fragment(self, key, fragment, reason):
+        """只把损坏的片段发给模型修复，返回修复后的元素列表；修复结果仍不可用时丢弃该片段"""
+        self.count_parse_stat("repair_requests")
+        self.metrics.inc("json_repair_requests_total", model=self.model, field=key)
+        user_message = f"【Field】: {key}\n【Problem】: {reason}\n【Broken fragment】:\n{fragment}"
+        output = self.call_openai_api(user_message, REPAIR_SYSTEM_PROMPT)
+        try:
+            value, _ = parse_json(self.remove_special_characters(output))
+            elements = normalize_elements(key, value)
+        except ValueError as e:
+            # 不可用的修复结果不能留在缓存中，否则重跑时会再次命中并丢弃同一个片段
+            self.discard_cached_response(user_message, REPAIR_SYSTEM_PROMPT)
+            self.count_parse_stat("dropped")
+            self.metrics.inc("json_repair_failures_total", model=self.model, field=key)
+            print(f"{key} 片段修复失败，已丢弃: {e}")
+            return []
+        self.count_parse_stat("repaired")
+        return elements
+
+    def stream_chat_completion(self, chunk, system_prompt, stream_state, max_continuations=3):
+        """流式调用 API，边接收边增量解析；输出因长度被截断或连接中断时，带上已收到的内容请求模型续写"""
+        continuations = 0
+        while True:
+            messages = [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": chunk},
+            ]
+            if stream_state["parts"]:
+                messages.append({"role": "assistant", "content": "".join(stream_state["parts"])})
+                messages.append({"role": "user", "content": CONTINUE_PROMPT})
+
+            response = self.client.chat.completions.create(
+                model=self.model,
+                messages=messages,
+                temperature=0.0,
+                timeout=300,
+                stream=True,
+                stream_options={"include_usage": True}
+            )
+            finish_reason = None
+            for event in response:
+                if event.usage:
+                    details = getattr(event.usage, "prompt_tokens_details", None)
+                    self.add_usage(event.usage.prompt_tokens, event.usage.completion_tokens, stream_state,
+                                   getattr(details, "cached_tokens", None) or 0)
+                if not event.choices:
+                    continue
+                choice = event.choices[0]
+                finish_reason = choice.finish_reason or finish_reason
+                text = choice.delta.content
+                if not text:
+                    continue
+                stream_state["parts"].append(text)
+                for key, element in stream_state["parser"].feed(text):
+                    self.handle_stream_element(key, element, stream_state)
+
+            if finish_reason != "length" or continuations >= max_continuations:
+                return "".join(stream_state["parts"])
+            continuations += 1
+            print(f"输出被截断，正在进行第 {continuations} 次续写...")
+
+    def handle_stream_element(self, key, element, stream_state):
+        """记录首个章节的到达时间，并把闭合的元素交给回调"""
+        if key == "sections" and not stream_state["first_section"]:
+            stream_state["first_section"] = True
+            with self._lock:
+                self.first_section_latencies.append(time.time() - stream_state["start_time"])
+        if self.on_stream_element:
+            self.on_stream_element(key, element)
+
+
+    def build_user_message(self, chunk, hierarchy_context=None):
+        """组装 user 消息：可变的层级上下文和 chunk 文本放在静态系统提示词之后"""
+        if hierarchy_context is None:
+            return f"【Raw OCR-scanned text】:\n{chunk}"
+        return f"【Previously generated hierarchy】:\n{hierarchy_context}\n\n【Raw OCR-scanned text】:\n{chunk}"
+
+    def process_single_chunk_first(self, chunk):
+        """处理单个 chunk 并调用 OpenAI 生成 JSON 数据"""
+        user_message = self.build_user_message(chunk)
+        chunk_json = self.request_chunk_json('first', user_message)
+
+        return chunk_json
+
+
+    def process_single_chunk_then(self, chunk, previous_hierarchy):
+        user_message = self.build_user_message(chunk, self.render_hierarchy(previous_hierarchy))
+        chunk_json = self.request_chunk_json('then', user_message)
 
         return chunk_json
 
-    def update_paper_structure(self, original_chunk_result, paper_structure):
-        # hard copy chunk_result
-        chunk_result = copy.deepcopy(original_chunk_result)
-        """更新生成的 paper 结构，只保留章节和子章节框架"""
-        if not chunk_result:
-            return paper_structure
-
-        # 遍历 chunk_result 中的每个元素，只要key为sections，就更新paper_structure
-        for key, value in chunk_result.items():
-            if key == "sections":
-                paper_structure['sections'].extend(value)
-        
-        # 删除paper_structure中的content, 只保留heading和subsections
-        def remove_content(section):
-            if "content" in section and section["content"] is not None:
-                del section["content"]
-            if "subsections" in section and section["subsections"] is not None:
-                for subsection in section["subsections"]:
-                    if subsection is not None:
-                        remove_content(subsection)
-
-        for section in paper_structure['sections']:
-            remove_content(section)
-        
-        return paper_structure
+
+    # todo
+    def process_single_chunk_final(self, chunk, previous_hierarchy):
+        user_message = self.build_user_message(chunk, self.render_hierarchy(previous_hierarchy))
+        chunk_json = self.request_chunk_json('final', user_message)
+
+        return chunk_json
 
     def save_json_to_file(self, paper_metadata, output_file):
-        """将 JSON 数据保存到文件"""
+        """将 JSON 数据逐个章节流式写入文件"""
         with open(output_file, "w", encoding="utf-8") as out_file:
-            json.dump(paper_metadata, out_file, ensure_ascii=False, indent=4)
-
-    def convert(self, input_file, output_file):
+            dump_paper(paper_metadata, out_file)
+
+    def manifest_settings(self, max_token):
+        """影响 chunk 划分和输出的设置，变化时不能做增量转换"""
+        settings = {'model': self.model, 'max_token': max_token, 'preclean': self.preclean,
+                    'tokenizer': self.tokenizer.name}
+        if self.local_parser:
+            settings['local_confidence'] = self.local_confidence
+        return settings
+
+    def convert(self, input_file, output_file, concurrent=False, max_workers=4, max_token=3000, resume=True,
+                incremental=False):
         md_text = self.read_md_file(input_file)
-        paper_metadata, _ = self.process_md_chunks(md_text, max_token=3000)
+        # 输出旁边保存 <name>.manifest.json，记录源文件哈希和每个 chunk 覆盖的章节，供增量转换和跳过检查使用
+        manifest = {'source_hash': hash_text(md_text), 'settings': self.manifest_settings(max_token),
+                    'chapters': [], 'tasks': []}
+        paper_metadata = None
+        journal = None
+        old_manifest = load_manifest(manifest_path(output_file)) if incremental else None
+        if old_manifest and old_manifest.get('settings') == manifest['settings'] and os.path.exists(output_file):
+            paper_metadata = self.process_md_chunks_incremental(md_text, self.read_json_file(output_file), old_manifest,
+                                                                max_token=max_token, max_workers=max_workers,
+                                                                manifest=manifest)
+            if paper_metadata is None:
+                print("已有输出与 manifest 不一致，重新完整转换")
+                manifest['tasks'] = []
+            else:
+                print(f"增量转换: 复用 {self.reused_chunks} 个 chunk，重新处理 {self.reprocessed_chunks} 个 chunk")
+
+        if paper_metadata is None:
+            # 每个 chunk 完成后写入 <output_file>.journal，中断后重跑时从第一个未完成的 chunk 继续
+            # 日志记录带有转换设置的哈希，换了模型、预清理模式等设置后重跑不会复用旧设置下的结果
+            journal = ChunkJournal(output_file + ".journal", manifest['settings']) if resume else None
+            if concurrent:
+                paper_metadata, _ = self.process_md_chunks_concurrent(md_text, max_token=max_token,
+                                                                      max_workers=max_workers, journal=journal,
+                                                                      manifest=manifest)
+            else:
+                paper_metadata, _ = self.process_md_chunks(md_text, max_token=max_token, journal=journal,
+                                                           manifest=manifest)
         self.save_json_to_file(paper_metadata, output_file)
+        save_manifest(manifest_path(output_file), manifest)
         print(f"JSON 文件已保存至 {output_file}")
+        if journal:
+            journal.remove()
+        if self.resumed_chunks:
+            print(f"从日志恢复的 chunk 数: {self.resumed_chunks}")
+        if self.cache:
+            print(f"缓存命中: {self.cache_hits}, 未命中: {self.cache_misses}")
+        if self.compact_hierarchy:
+            print(f"层级上下文节省 tokens: {self.hierarchy_tokens_saved}")
+        if self.preclean_stats:
+            for rule, stats in self.preclean_stats.items():
+                print(f"预清理 {rule}: {stats['matches']} 处, {stats['bytes']} 字节, {stats['tokens']} tokens")
+        if self.local_parser and self.local_chunks + self.llm_chunks:
+            print(f"本地解析 chunk: {self.local_chunks}/{self.local_chunks + self.llm_chunks}，"
+                  f"避免了 {self.local_chunks / (self.local_chunks + self.llm_chunks):.0%} 的 LLM 调用")
+        if self.parse_stats:
+            print("JSON 解析统计: " + ", ".join(f"{name} {count}" for name, count in sorted(self.parse_stats.items())))
+        if self.first_section_latencies:
+            print(f"首个章节平均到达时间: {sum(self.first_section_latencies) / len(self.first_section_latencies):.2f} 秒")
 
 if __name__ == "__main__":
     # (0.00875 + 0.035) / (0.004 + 0.012) = 2.73
@@ -309,17 +875,27 @@ if __name__ == "__main__":
             "key": "sk-a1ec916362f94e9daf9a0147ad376f54",
             "base_url": "https://dashscope.aliyuncs.com/compatible-mode/v1",
             "input_price": 0.004,
-            "output_price": 0.012
+            "output_price": 0.012,
+            "cached_input_price": 0.0016,
+            "requests_per_minute": 600,
+            "tokens_per_minute": 1000000
         },
         "gpt-4o": {
             "key": "fk216003-Hrxi38NKWLTTErTeh75OJiLIj95rmg69",
             "base_url": "https://openai.api2d.net",
             "input_price": 0.00875,
-            "output_price": 0.035
+            "output_price": 0.035,
+            "cached_input_price": 0.004375,
+            "requests_per_minute": 500,
+            "tokens_per_minute": 300000
         }
     }
     selected_llm = "qwen2.5-72b-instruct"
-    converter = MDToJSONConverter(llm_dict[selected_llm]["key"], llm_dict[selected_llm]["base_url"], selected_llm)
+    cache = LLMResponseCache(".llm_cache.sqlite")
+    # 每分钟请求数和 token 数上限请按账号的实际配额调整
+    rate_limiter = RateLimiter(llm_dict[selected_llm]["requests_per_minute"], llm_dict[selected_llm]["tokens_per_minute"])
+    converter = MDToJSONConverter(llm_dict[selected_llm]["key"], llm_dict[selected_llm]["base_url"], selected_llm,
+                                  cache=cache, rate_limiter=rate_limiter)
     
     file_name = "1-s2.0-S0040162523008284-main.md"
     start_time = time.time()
@@ -328,5 +904,7 @@ if __name__ == "__main__":
     conversion_time = end_time - start_time
     
     print(f"转换耗时: {conversion_time:.2f} 秒")
-    print(f"输入tokens: {converter.prompt_tokens} , 输出tokens: {converter.completion_tokens}")
-    print(f"总成本: ${converter.calculate_token_price(llm_dict[selected_llm]['input_price'], llm_dict[selected_llm]['output_price']):.4f}")
\ No newline at end of file
+    print(f"输入tokens: {converter.prompt_tokens} (缓存命中 {converter.cached_prompt_tokens}), 输出tokens: {converter.completion_tokens}")
+    print(f"总成本: ${converter.calculate_token_price(llm_dict[selected_llm]['input_price'], llm_dict[selected_llm]['output_price'], llm_dict[selected_llm]['cached_input_price']):.4f}")
+    print(f"缓存命中: {converter.cache_hits}, 未命中: {converter.cache_misses}")
+    print(f"层级上下文节省 tokens: {converter.hierarchy_tokens_saved}")
@@ -0,0 +1,102 @@
+import contextlib
+import json
+import threading
+import time
+from collections import defaultdict
+
+
+class Metrics:
+    """线程安全的指标收集器：累计计数器和分布（次数/总和/最小/最大），可导出为 JSON lines 或 Prometheus 文本"""
+
+    def __init__(self, jsonl_path=None, prefix="md2json"):
+        self.prefix = prefix
+        self.counters = defaultdict(float)
+        self.summaries = {}
+        self._lock = threading.Lock()
+        # 指定 jsonl_path 时每次记录都追加一行事件，便于逐次请求追踪
+        self._jsonl_file = open(jsonl_path, "a", encoding="utf-8") if jsonl_path else None
+
+    def _write_event(self, kind, name, value, labels):
+        if self._jsonl_file:
+            event = {"ts": time.time(), "type": kind, "metric": name, "value": value, **labels}
+            self._jsonl_file.write(json.dumps(event, ensure_ascii=False) + "\n")
+
+    def inc(self, name, value=1, **labels):
+        """计数器加 value"""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] += value
+            self._write_event("counter", name, value, labels)
+
+    def observe(self, name, value, **labels):
+        """记录一次观测值（耗时、大小等）"""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            summary = self.summaries.get(key)
+            if summary is None:
+                self.summaries[key] = [1, value, value, value]
+            else:
+                summary[0] += 1
+                summary[1] += value
+                summary[2] = min(summary[2], value)
+                summary[3] = max(summary[3], value)
+            self._write_event("observation", name, value, labels)
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        """统计代码块耗时，记为 <name>_seconds"""
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(f"{name}_seconds", time.perf_counter() - start_time, **labels)
+
+    def summary(self):
+        """返回可序列化的汇总结果"""
+        with self._lock:
+            result = {}
+            for (name, labels), value in self.counters.items():
+                result.setdefault(name, []).append({"labels": dict(labels), "value": value})
+            for (name, labels), (count, total, minimum, maximum) in self.summaries.items():
+                result.setdefault(name, []).append({
+                    "labels": dict(labels), "count": count, "sum": total,
+                    "min": minimum, "max": maximum, "avg": total / count,
+                })
+            return result
+
+    def to_prometheus(self):
+        """导出为 Prometheus 文本格式"""
+        def format_labels(labels, extra=()):
+            items = list(labels) + list(extra)
+            if not items:
+                return ""
+            return "{" + ",".join(f'{key}="{str(value)}"' for key, value in items) + "}"
+
+        lines = []
+        with self._lock:
+            for name in sorted({name for name, _ in self.counters}):
+                metric = f"{self.prefix}_{name}"
+                lines.append(f"# TYPE {metric} counter")
+                for (counter_name, labels), value in self.counters.items():
+                    if counter_name == name:
+                        lines.append(f"{metric}{format_labels(labels)} {value}")
+            for name in sorted({name for name, _ in self.summaries}):
+                metric = f"{self.prefix}_{name}"
+                lines.append(f"# TYPE {metric} summary")
+                for (summary_name, labels), (count, total, minimum, maximum) in self.summaries.items():
+                    if summary_name == name:
+                        lines.append(f"{metric}_count{format_labels(labels)} {count}")
+                        lines.append(f"{metric}_sum{format_labels(labels)} {total}")
+                        lines.append(f"{metric}{format_labels(labels, [('quantile', '0')])} {minimum}")
+                        lines.append(f"{metric}{format_labels(labels, [('quantile', '1')])} {maximum}")
+        return "\n".join(lines) + "\n"
+
+    def save_prometheus(self, path):
+        with open(path, "w", encoding="utf-8") as file:
+            file.write(self.to_prometheus())
+
+    def close(self):
+        with self._lock:
+            if self._jsonl_file:
+                self._jsonl_file.close()
+                self._jsonl_file = None
@@ -0,0 +1,194 @@
+import json
+import json5
+from stream_parser import IncrementalJSONParser
+
+try:
+    import orjson
+except ImportError:  # 没有安装 orjson 时严格解析使用标准库 json
+    orjson = None
+
+STRICT_PARSER = "orjson" if orjson else "json"
+METADATA_STRING_FIELDS = ("title", "abstract")
+METADATA_LIST_FIELDS = ("authors", "keywords")
+SECTION_FIELDS = ("heading", "content", "subsections")
+REFERENCE_FIELDS = ("paper_name", "content")
+
+
+class BrokenFragment:
+    """结果列表中无法使用的元素占位：保存原文和原因，等待单独修复"""
+    __slots__ = ("text", "reason")
+
+    def __init__(self, text, reason):
+        self.text = text
+        self.reason = reason
+
+
+def parse_json(text):
+    """先用严格解析器，失败时再用 json5 宽松解析；返回 (结果, 解析器名称)，都失败时抛出 ValueError"""
+    try:
+        return (orjson.loads(text) if orjson else json.loads(text)), STRICT_PARSER
+    except ValueError:
+        pass
+    return json5.loads(text), "json5"
+
+
+def salvage_json(text):
+    """整体解析失败时，取出已闭合的 sections/references 元素以及它们之前的元数据字段；
+    无法解析或被截断的元素以 BrokenFragment 占位，完全没有可用内容时抛出 ValueError"""
+    parser = IncrementalJSONParser()
+    elements = parser.feed(text)
+    if not parser.started:
+        raise ValueError("输出中没有 JSON 对象")
+
+    result = {}
+    if parser.first_array_at is not None:
+        header = text[text.index("{"):parser.first_array_at].rstrip().rstrip(",") + "}"
+        try:
+            value, _ = parse_json(header)
+        except ValueError:
+            value = None
+        if isinstance(value, dict):
+            result.update(value)
+    for key, element in elements:
+        result.setdefault(key, []).append(element)
+
+    # 损坏元素按原来的位置插回，保持文档顺序
+    fragments = [(key, index, fragment, "malformed JSON") for key, index, fragment in parser.failed]
+    unfinished = parser.unfinished_element()
+    if unfinished:
+        fragments.append((*unfinished, "truncated JSON"))
+    for key, index, fragment, reason in fragments:
+        result.setdefault(key, []).insert(index, BrokenFragment(fragment, reason))
+    if not result:
+        raise ValueError("输出中没有可以恢复的内容")
+    return result
+
+
+def dump_fragment(value):
+    return json.dumps(value, ensure_ascii=False)
+
+
+def to_text(value):
+    """把模型误输出为列表或其他类型的文本字段转为字符串"""
+    if isinstance(value, list):
+        return "\n\n".join(str(item) for item in value if item is not None)
+    return str(value)
+
+
+def normalize_section(section):
+    """检查单个章节，能在本地修正的直接修正；返回 (章节, 本地修正次数, 问题原因或 None)"""
+    if isinstance(section, str):
+        return {"heading": None, "content": section, "subsections": []}, 1, None
+    if not isinstance(section, dict):
+        return section, 0, f"section must be an object, got {type(section).__name__}"
+    if not any(field in section for field in SECTION_FIELDS):
+        return section, 0, "section has none of the keys 'heading', 'content', 'subsections'"
+
+    coerced = 0
+    for field in ("heading", "content"):
+        value = section.get(field)
+        if value is not None and not isinstance(value, str):
+            if isinstance(value, dict):
+                return section, coerced, f"'{field}' must be a string, got an object"
+            section[field] = to_text(value)
+            coerced += 1
+
+    subsections = section.get("subsections")
+    if isinstance(subsections, dict):
+        subsections = section["subsections"] = [subsections]
+        coerced += 1
+    if subsections is not None and not isinstance(subsections, list):
+        return section, coerced, "'subsections' must be a list of sections"
+    for index, subsection in enumerate(subsections or []):
+        subsection, sub_coerced, reason = normalize_section(subsection)
+        if reason:
+            return section, coerced, f"subsection {index + 1}: {reason}"
+        subsections[index] = subsection
+        coerced += sub_coerced
+    return section, coerced, None
+
+
+def normalize_reference(reference):
+    """检查单条参考文献；返回 (参考文献, 本地修正次数, 问题原因或 None)"""
+    if isinstance(reference, str):
+        return reference, 0, "reference must be an object with 'paper_name' and 'content'"
+    if not isinstance(reference, dict):
+        return reference, 0, f"reference must be an object, got {type(reference).__name__}"
+    if not any(field in reference for field in REFERENCE_FIELDS):
+        return reference, 0, "reference has neither 'paper_name' nor 'content'"
+    coerced = 0
+    for field in REFERENCE_FIELDS:
+        value = reference.get(field)
+        if value is not None and not isinstance(value, str):
+            reference[field] = to_text(value)
+            coerced += 1
+    return reference, coerced, None
+
+
+NORMALIZERS = {"sections": normalize_section, "references": normalize_reference}
+
+
+def normalize_chunk(kind, result):
+    """按 chunk 类型检查 title/authors/abstract/keywords/sections/references 的结构，
+    能在本地修正的（字符串与列表互转、单个对象包成数组等）直接修正；
+    返回 (结果, 本地修正次数, 问题列表)，问题为 (key, 下标, 片段原文, 原因)，需要交给模型修复"""
+    coerced = 0
+    if isinstance(result, list):
+        result = {"sections": result}
+        coerced += 1
+    elif isinstance(result, dict) and kind != "first" and "sections" not in result and "heading" in result:
+        result = {"sections": [result]}
+        coerced += 1
+    if not isinstance(result, dict):
+        raise ValueError(f"output must be a JSON object, got {type(result).__name__}")
+
+    if kind == "first":
+        for field in METADATA_STRING_FIELDS:
+            if field in result and not isinstance(result[field], str):
+                result[field] = "" if result[field] is None else to_text(result[field])
+                coerced += 1
+        for field in METADATA_LIST_FIELDS:
+            if field in result and not isinstance(result[field], list):
+                result[field] = [result[field]] if result[field] else []
+                coerced += 1
+
+    problems = []
+    for key, normalize in NORMALIZERS.items():
+        if key not in result:
+            continue
+        elements = result[key]
+        if elements is None:
+            elements = []
+            coerced += 1
+        elif isinstance(elements, dict):
+            elements = [elements]
+            coerced += 1
+        elif not isinstance(elements, list):
+            elements = [BrokenFragment(dump_fragment(elements), f"'{key}' must be a list")]
+        for index, element in enumerate(elements):
+            if isinstance(element, BrokenFragment):
+                problems.append((key, index, element.text, element.reason))
+                continue
+            element, element_coerced, reason = normalize(element)
+            elements[index] = element
+            coerced += element_coerced
+            if reason:
+                problems.append((key, index, dump_fragment(element), reason))
+        result[key] = elements
+    return result, coerced, problems
+
+
+def normalize_elements(key, value):
+    """检查修复请求返回的元素列表，仍有问题时抛出 ValueError"""
+    if isinstance(value, dict) and key in value:
+        value = value[key]
+    if isinstance(value, dict):
+        value = [value]
+    if not isinstance(value, list):
+        raise ValueError(f"repair output must be a list, got {type(value).__name__}")
+    for index, element in enumerate(value):
+        element, _, reason = NORMALIZERS[key](element)
+        if reason:
+            raise ValueError(reason)
+        value[index] = element
+    return value
@@ -0,0 +1,163 @@
+import re
+import unicodedata
+
+IMAGE_PATTERN = re.compile(r"!\[[^\]\n]*\]\([^)\n]*\)|<img\b[^>\n]*>", re.IGNORECASE)
+DISPLAY_MATH_INLINE_PATTERN = re.compile(r"\$\$.+?\$\$|\\\[.+?\\\]")
+DISPLAY_MATH_FENCE_PATTERN = re.compile(r"^\s*(\$\$|\\\[|\\\])")
+INLINE_MATH_PATTERN = re.compile(r"(?<![\\$])\$(?![\s$])[^$\n]{1,200}?(?<![\s\\])\$(?!\d)")
+TABLE_ROW_PATTERN = re.compile(r"^\s*\|.*\|\s*$")
+TABLE_SEPARATOR_PATTERN = re.compile(r"^\s*\|?\s*:?-{3,}:?\s*(\|\s*:?-{3,}:?\s*)*\|?\s*$")
+HTML_BLOCK_START_PATTERN = re.compile(r"^\s*<(table|div|figure|figcaption|svg|math|iframe|center|!--)\b", re.IGNORECASE)
+HTML_BLOCK_END_PATTERN = re.compile(r"</(table|div|figure|figcaption|svg|math|iframe|center)>|-->", re.IGNORECASE)
+HTML_TAG_PATTERN = re.compile(r"</?[a-zA-Z][a-zA-Z0-9]*(\s[^<>\n]*)?/?>")
+# 与 md2json 拆分章节时使用的 #/## 标题一致
+SECTION_HEADING_PATTERN = re.compile(r"^#{1,2} ")
+GARBAGE_TOKEN_PATTERN = re.compile(r"\S{6,}")
+
+MODES = ("conservative", "strict")
+
+
+# 日文假名、韩文和汉字在同一段文字中混用很常见，视为同一种文字
+CJK_SCRIPTS = {"CJK", "HIRAGANA", "KATAKANA", "HANGUL", "IDEOGRAPHIC"}
+
+
+def is_noise_char(ch):
+    """私用区、未分配、控制字符、替换字符以及制表符/方块符号只会来自 OCR 或编码错误"""
+    return (unicodedata.category(ch) in ("Co", "Cn", "Cs", "Cc") or ch == "\ufffd"
+            or "\u2500" <= ch <= "\u25ff")
+
+
+def letter_script(ch):
+    script = unicodedata.name(ch, "UNKNOWN").split()[0]
+    return "CJK" if script in CJK_SCRIPTS else script
+
+
+def is_garbage_token(token, strict):
+    """OCR 乱码：噪声字符占比高，或字母混杂三种以上文字；strict 模式下符号占比高的片段（如编码错乱）也算。
+    任何单一文字（西里尔、希腊、假名、韩文等）的字母都视为正文"""
+    noise = sum(1 for ch in token if is_noise_char(ch))
+    if noise / len(token) >= (0.3 if strict else 0.5):
+        return True
+    scripts = {letter_script(ch) for ch in token if ch.isalpha()}
+    if len(scripts) >= 3:
+        return True
+    if strict:
+        symbols = sum(1 for ch in token if unicodedata.category(ch).startswith("S"))
+        return symbols / len(token) >= 0.4
+    return False
+
+
+class MarkdownPreCleaner:
+    """在发送给 LLM 之前逐行清除图片、公式、表格、HTML 块和乱码，并统计每条规则移除的字节数和 token 数
+
+    conservative 模式只移除图片、独立公式、带分隔行的表格、HTML 块和明显的乱码；
+    strict 模式还会移除行内公式、所有以 | 包围的行和行内 HTML 标签。
+    """
+
+    def __init__(self, mode="conservative", count_tokens=None):
+        if mode not in MODES:
+            raise ValueError(f"未知的清理模式: {mode}，可选: {', '.join(MODES)}")
+        self.strict = mode == "strict"
+        self.count_tokens = count_tokens or (lambda text: len(text.split()))
+        self.stats = {}
+
+    def record(self, rule, removed):
+        if not removed:
+            return
+        stats = self.stats.setdefault(rule, {"matches": 0, "bytes": 0, "tokens": 0})
+        stats["matches"] += 1
+        stats["bytes"] += len(removed.encode("utf-8"))
+        stats["tokens"] += self.count_tokens(removed)
+
+    def sub(self, rule, pattern, line):
+        def remove(match):
+            self.record(rule, match.group(0))
+            return ""
+        return pattern.sub(remove, line)
+
+    def clean_inline(self, line):
+        """清理单行内的图片、公式、HTML 标签和乱码"""
+        line = self.sub("image", IMAGE_PATTERN, line)
+        line = self.sub("display_math", DISPLAY_MATH_INLINE_PATTERN, line)
+        if self.strict:
+            line = self.sub("inline_math", INLINE_MATH_PATTERN, line)
+            line = self.sub("html", HTML_TAG_PATTERN, line)
+
+        def remove_garbage(match):
+            token = match.group(0)
+            if is_garbage_token(token, self.strict):
+                self.record("garbage", token)
+                return ""
+            return token
+        return GARBAGE_TOKEN_PATTERN.sub(remove_garbage, line)
+
+    def flush_table(self, rows):
+        """表格块结束：strict 模式或存在分隔行时整体删除，否则原样保留"""
+        if self.strict or any(TABLE_SEPARATOR_PATTERN.match(row) for row in rows):
+            self.record("table", "\n".join(rows))
+            return []
+        return [self.clean_inline(row) for row in rows]
+
+    def clean_lines(self, lines):
+        """逐行处理的生成器，可直接处理文件对象等行迭代器"""
+        block = None
+        block_lines = []
+        table_rows = []
+        for raw_line in lines:
+            line = raw_line.rstrip("\n")
+
+            # 未闭合的公式/HTML 块遇到章节标题时放弃，块内各行原样保留，避免吞掉后面的章节
+            if block and SECTION_HEADING_PATTERN.match(line):
+                yield from block_lines
+                block, block_lines = None, []
+
+            if block == "math":
+                block_lines.append(line)
+                if DISPLAY_MATH_FENCE_PATTERN.match(line) or line.rstrip().endswith(("$$", "\\]")):
+                    self.record("display_math", "\n".join(block_lines))
+                    block, block_lines = None, []
+                continue
+            if block == "html":
+                block_lines.append(line)
+                if HTML_BLOCK_END_PATTERN.search(line) or (self.strict and not line.strip()):
+                    self.record("html", "\n".join(block_lines))
+                    block, block_lines = None, []
+                continue
+
+            if TABLE_ROW_PATTERN.match(line) or (table_rows and TABLE_SEPARATOR_PATTERN.match(line)):
+                table_rows.append(line)
+                continue
+            if table_rows:
+                yield from self.flush_table(table_rows)
+                table_rows = []
+
+            # 标题行只做行内清理，保证后续按 # 拆分章节不受影响
+            if not line.lstrip().startswith("#"):
+                # 同一行内已闭合的 $$...$$ 交给 clean_inline 处理，剩下的 $$ 或 \[ 开头才是多行公式块
+                stripped = DISPLAY_MATH_INLINE_PATTERN.sub("", line).strip()
+                if stripped.startswith(("$$", "\\[")) and "$$" not in stripped[2:] and "\\]" not in stripped:
+                    block, block_lines = "math", [line]
+                    continue
+                if HTML_BLOCK_START_PATTERN.match(line):
+                    if HTML_BLOCK_END_PATTERN.search(line):
+                        self.record("html", line)
+                    else:
+                        block, block_lines = "html", [line]
+                    continue
+
+            yield self.clean_inline(line)
+
+        if table_rows:
+            yield from self.flush_table(table_rows)
+        # 未闭合的块原样保留，避免误删正文
+        yield from block_lines
+
+    def clean(self, text):
+        """清理整段文本，并合并清理后产生的多余空行"""
+        cleaned = "\n".join(self.clean_lines(text.split("\n")))
+        return re.sub(r"\n{3,}", "\n\n", cleaned)
+
+    def total_removed(self):
+        """返回 (移除的字节数, 移除的 token 数)"""
+        return (sum(stats["bytes"] for stats in self.stats.values()),
+                sum(stats["tokens"] for stats in self.stats.values()))
@@ -0,0 +1,114 @@
+import random
+import threading
+import time
+
+import openai
+
+# 可以重试的 HTTP 状态码，其余 4xx（参数错误、鉴权失败等）直接失败
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+
+class RateLimiter:
+    """所有在途请求共享的令牌桶限流器：同时限制每分钟请求数和 token 数，被限流时整体暂停并降速"""
+
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None, min_rate_factor=0.25):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.min_rate_factor = min_rate_factor
+        # 收到 429 时速率减半，之后每次成功逐步恢复
+        self.rate_factor = 1.0
+        self.request_allowance = requests_per_minute or 0
+        self.token_allowance = tokens_per_minute or 0
+        self.blocked_until = 0
+        self.updated_at = time.monotonic()
+        self._condition = threading.Condition()
+
+    def _refill(self, now):
+        elapsed = now - self.updated_at
+        self.updated_at = now
+        if self.requests_per_minute:
+            self.request_allowance = min(self.requests_per_minute,
+                                         self.request_allowance + elapsed * self.requests_per_minute * self.rate_factor / 60)
+        if self.tokens_per_minute:
+            self.token_allowance = min(self.tokens_per_minute,
+                                       self.token_allowance + elapsed * self.tokens_per_minute * self.rate_factor / 60)
+
+    def acquire(self, tokens):
+        """阻塞直到有一个请求和 tokens 个 token 的额度"""
+        if self.tokens_per_minute:
+            tokens = min(tokens, self.tokens_per_minute)
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                if self.blocked_until > now:
+                    wait = self.blocked_until - now
+                elif self.requests_per_minute and self.request_allowance < 1:
+                    wait = (1 - self.request_allowance) * 60 / (self.requests_per_minute * self.rate_factor)
+                elif self.tokens_per_minute and self.token_allowance < tokens:
+                    wait = (tokens - self.token_allowance) * 60 / (self.tokens_per_minute * self.rate_factor)
+                else:
+                    self.request_allowance -= 1
+                    self.token_allowance -= tokens
+                    return
+                self._condition.wait(wait)
+
+    def record_usage(self, estimated_tokens, actual_tokens):
+        """用实际用量修正预估的 token 额度"""
+        with self._condition:
+            self.token_allowance -= actual_tokens - estimated_tokens
+
+    def on_success(self):
+        with self._condition:
+            self.rate_factor = min(1.0, self.rate_factor + 0.05)
+
+    def on_rate_limited(self, retry_after=None):
+        """被限流：所有请求暂停到 retry_after 之后，并降低速率"""
+        with self._condition:
+            self.rate_factor = max(self.min_rate_factor, self.rate_factor / 2)
+            if retry_after:
+                self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+            self._condition.notify_all()
+
+
+def get_status_code(error):
+    status_code = getattr(error, "status_code", None)
+    if status_code is None and getattr(error, "response", None) is not None:
+        status_code = getattr(error.response, "status_code", None)
+    return status_code
+
+
+def is_retryable_error(error):
+    """429 和 5xx 等状态码、超时和连接错误（包括流式响应中途断开）可以重试；
+    其余 4xx 以及响应格式异常、程序错误等重试也不会成功，直接失败"""
+    if isinstance(error, openai.APIConnectionError):
+        return True
+    status_code = get_status_code(error)
+    if status_code is not None:
+        return status_code in RETRYABLE_STATUS_CODES or status_code >= 500
+    return False
+
+
+def is_rate_limit_error(error):
+    return get_status_code(error) == 429
+
+
+def get_retry_after(error):
+    """从响应头中读取 Retry-After（秒），没有时返回 None"""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except (TypeError, ValueError):
+        return None
+    return None
+
+
+def backoff_delay(attempt, base=2.0, cap=60.0):
+    """带完全抖动的指数退避，避免并发请求同时重试"""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
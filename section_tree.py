@@ -0,0 +1,123 @@
+import json
+
+# 输出格式固定为标准库 json 的 4 空格缩进，与是否安装了可选依赖无关
+INDENT = 4
+SECTION_FIELDS = ("heading", "content", "subsections")
+# 区分模型输出中缺失的字段和值为 null 的字段，序列化时保持原样
+MISSING = object()
+
+
+def encode(value, level=0):
+    """编码单个值，多行结果按所在层级缩进"""
+    text = json.dumps(value, ensure_ascii=False, indent=INDENT)
+    if level:
+        text = text.replace("\n", "\n" + " " * (INDENT * level))
+    return text
+
+
+class SectionNode:
+    """单个章节：标题、正文和子章节；模型返回的其他字段原样保存在 extra 中"""
+    __slots__ = ("heading", "content", "subsections", "extra")
+
+    def __init__(self, heading=MISSING, content=MISSING, subsections=MISSING, extra=None):
+        self.heading = heading
+        self.content = content
+        self.subsections = subsections
+        self.extra = extra
+
+    @classmethod
+    def from_dict(cls, section):
+        subsections = section.get("subsections", MISSING)
+        if isinstance(subsections, list):
+            subsections = [cls.from_dict(sub) if isinstance(sub, dict) else sub for sub in subsections]
+        extra = {key: value for key, value in section.items() if key not in SECTION_FIELDS} or None
+        return cls(section.get("heading", MISSING), section.get("content", MISSING), subsections, extra)
+
+    def child_nodes(self):
+        if isinstance(self.subsections, list):
+            return [sub for sub in self.subsections if isinstance(sub, SectionNode)]
+        return []
+
+    def to_dict(self):
+        result = {}
+        if self.heading is not MISSING:
+            result["heading"] = self.heading
+        if self.content is not MISSING:
+            result["content"] = self.content
+        if isinstance(self.subsections, list):
+            result["subsections"] = [sub.to_dict() if isinstance(sub, SectionNode) else sub
+                                     for sub in self.subsections]
+        elif self.subsections is not MISSING:
+            result["subsections"] = self.subsections
+        if self.extra:
+            result.update(self.extra)
+        return result
+
+    def outline(self):
+        """只含标题和子章节的视图，与旧版去掉 content 的层级格式一致"""
+        return {"heading": None if self.heading is MISSING else self.heading,
+                "subsections": [sub.outline() for sub in self.child_nodes()]}
+
+
+class SectionTree:
+    """按文档顺序追加章节的树：追加时同步维护 (编号元组, 标题) 大纲，层级上下文直接读取大纲而不复制章节内容"""
+    __slots__ = ("sections", "entries", "_top_level", "legacy_tokens")
+
+    def __init__(self, sections=None):
+        self.sections = []
+        self.entries = []
+        self._top_level = 0
+        # [已计入的大纲条目数, 旧版 dict 大纲的估算 token 数]，由转换器随章节追加增量更新
+        self.legacy_tokens = [0, 0]
+        self.extend(sections)
+
+    def __len__(self):
+        return len(self.sections)
+
+    def __iter__(self):
+        return iter(self.sections)
+
+    def append(self, section):
+        """追加一个章节；不是 dict 的异常元素原样保留，但不计入大纲"""
+        if isinstance(section, dict):
+            section = SectionNode.from_dict(section)
+        self.sections.append(section)
+        if isinstance(section, SectionNode):
+            self._top_level += 1
+            self._add_entries(section, (self._top_level,))
+
+    def extend(self, sections):
+        for section in sections or []:
+            self.append(section)
+
+    def _add_entries(self, node, number):
+        heading = node.heading if node.heading is not MISSING else None
+        self.entries.append((number, str(heading or "").strip()))
+        for index, sub in enumerate(node.child_nodes()):
+            self._add_entries(sub, number + (index + 1,))
+
+    def outline(self):
+        """只含标题的层级结构，用于非紧凑模式的提示词"""
+        return {"sections": [section.outline() for section in self.sections if isinstance(section, SectionNode)]}
+
+    def to_list(self):
+        return [section.to_dict() if isinstance(section, SectionNode) else section for section in self.sections]
+
+
+def dump_paper(paper_metadata, file):
+    """逐个字段、逐个列表元素写入文件，不在内存中拼出完整的 JSON 字符串"""
+    pad = " " * INDENT
+    if not paper_metadata:
+        file.write("{}")
+        return
+    file.write("{")
+    for index, (key, value) in enumerate(paper_metadata.items()):
+        file.write(("," if index else "") + "\n" + pad + encode(str(key)) + ": ")
+        if not isinstance(value, list) or not value:
+            file.write(encode(value, 1))
+            continue
+        file.write("[")
+        for item_index, item in enumerate(value):
+            file.write(("," if item_index else "") + "\n" + pad * 2 + encode(item, 2))
+        file.write("\n" + pad + "]")
+    file.write("\n}")
@@ -0,0 +1,86 @@
+import json5
+
+
+class IncrementalJSONParser:
+    """增量 JSON 解析器：逐段喂入模型输出，顶层 sections/references 数组中的元素一闭合就解析返回"""
+
+    def __init__(self, keys=("sections", "references")):
+        self.keys = set(keys)
+        self.started = False
+        self.depth = 0
+        # 当前所在字符串的引号（" 或 json5 的 '），不在字符串中时为 None
+        self.quote = None
+        self.escape = False
+        self.string_chars = []
+        self.last_string = None
+        self.array_key = None
+        self.element_chars = None
+        # 供整体解析失败时抢救部分结果：每个 key 已闭合的元素数、无法解析的元素 (key, 下标, 原文)，
+        # 以及第一个 sections/references 键在已喂入文本中的位置
+        self.position = 0
+        self.string_start = None
+        self.first_array_at = None
+        self.counts = {}
+        self.failed = []
+
+    def feed(self, text):
+        """喂入一段文本，返回本段中闭合的 (key, 元素) 列表"""
+        elements = []
+        for ch in text:
+            self.position += 1
+            # 跳过 ```json 等 JSON 对象之前的内容
+            if not self.started:
+                if ch == "{":
+                    self.started = True
+                    self.depth = 1
+                continue
+            if self.element_chars is not None:
+                self.element_chars.append(ch)
+
+            if self.quote:
+                if self.escape:
+                    self.escape = False
+                elif ch == "\\":
+                    self.escape = True
+                elif ch == self.quote:
+                    self.quote = None
+                    if self.depth == 1:
+                        self.last_string = "".join(self.string_chars)
+                elif self.depth == 1:
+                    self.string_chars.append(ch)
+                continue
+
+            if ch in "\"'":
+                self.quote = ch
+                self.string_chars = []
+                if self.depth == 1:
+                    self.string_start = self.position - 1
+            elif ch in "{[":
+                if self.depth == 1 and ch == "[":
+                    self.array_key = self.last_string if self.last_string in self.keys else None
+                    if self.array_key and self.first_array_at is None:
+                        self.first_array_at = self.string_start
+                elif self.depth == 2 and ch == "{" and self.array_key:
+                    self.element_chars = ["{"]
+                self.depth += 1
+            elif ch in "}]":
+                self.depth -= 1
+                if self.depth == 2 and ch == "}" and self.element_chars is not None:
+                    element_text = "".join(self.element_chars)
+                    index = self.counts.get(self.array_key, 0)
+                    self.counts[self.array_key] = index + 1
+                    try:
+                        elements.append((self.array_key, json5.loads(element_text)))
+                    except ValueError:
+                        # 元素本身不合法时不提前返回，交给整体解析处理
+                        self.failed.append((self.array_key, index, element_text))
+                    self.element_chars = None
+                elif self.depth == 1 and ch == "]":
+                    self.array_key = None
+        return elements
+
+    def unfinished_element(self):
+        """输出被截断时尚未闭合的元素，返回 (key, 下标, 原文) 或 None"""
+        if self.element_chars is None:
+            return None
+        return self.array_key, self.counts.get(self.array_key, 0), "".join(self.element_chars)
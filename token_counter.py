@@ -0,0 +1,54 @@
+import functools
+import re
+
+CJK_PATTERN = re.compile(r"[\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uff00-\uffef]")
+
+
+class BaseTokenizer:
+    """分词器基类，count 结果按文本缓存"""
+    name = "base"
+
+    def __init__(self, cache_size=65536):
+        self.count = functools.lru_cache(maxsize=cache_size)(self._count)
+
+    def _count(self, text):
+        raise NotImplementedError
+
+
+class HeuristicTokenizer(BaseTokenizer):
+    """启发式计数：每个中日韩字符计一个 token，其余文本按空白分词计数"""
+    name = "heuristic"
+
+    def _count(self, text):
+        cjk_count = len(CJK_PATTERN.findall(text))
+        if cjk_count:
+            text = CJK_PATTERN.sub(" ", text)
+        return cjk_count + len(text.split())
+
+
+class TiktokenTokenizer(BaseTokenizer):
+    """基于 tiktoken BPE 词表的精确计数（需要安装 tiktoken）"""
+    name = "tiktoken"
+
+    def __init__(self, encoding_name="cl100k_base", cache_size=65536):
+        import tiktoken
+        super().__init__(cache_size)
+        self.encoding = tiktoken.get_encoding(encoding_name)
+
+    def _count(self, text):
+        return len(self.encoding.encode(text, disallowed_special=()))
+
+
+TOKENIZERS = {
+    HeuristicTokenizer.name: HeuristicTokenizer,
+    TiktokenTokenizer.name: TiktokenTokenizer,
+}
+
+
+def get_tokenizer(tokenizer="heuristic"):
+    """根据名称创建分词器；传入分词器实例时原样返回"""
+    if isinstance(tokenizer, BaseTokenizer):
+        return tokenizer
+    if tokenizer not in TOKENIZERS:
+        raise ValueError(f"未知的分词器: {tokenizer}，可选: {', '.join(TOKENIZERS)}")
+    return TOKENIZERS[tokenizer]()